@@ -0,0 +1,134 @@
+"""
+Load generator to compare configurations of the same app.
+
+Starts the app once per configuration, sends concurrent requests to the given paths and
+reports throughput, latency percentiles and bytes on the wire.
+
+    python benchmarks/load.py --app-dir ecommerce-rdb \
+        --config DB_ASYNC=false --config DB_ASYNC=true \
+        --path /store/products/ --path "/store/search?query=shoe"
+
+Each --config is a comma separated list of environment variables for one run. Runs after the
+first are also compared against it, e.g. the bytes and CPU time compression costs or saves:
+
+    python benchmarks/load.py --app-dir ecommerce-rdb \
+        --config RESPONSE_COMPRESSION=false --config RESPONSE_COMPRESSION=true \
+        --path "/store/products/?limit=100" --header "Accept-Encoding: br, gzip"
+
+Requires httpx and uvicorn, and psutil to report server CPU time per request.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def parse_config(config: str) -> dict:
+    return dict(item.split("=", 1) for item in config.split(",") if item)
+
+
+def start_server(app_dir: str, port: int, env: dict) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=app_dir,
+        env={**os.environ, **env},
+    )
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/docs")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("Server did not start in time")
+
+
+async def run_load(client: httpx.AsyncClient, paths: list, total: int, concurrency: int, headers: dict) -> dict:
+    latencies, errors, wire_bytes = [], 0, 0
+    counter = iter(range(total))
+
+    async def worker():
+        nonlocal errors, wire_bytes
+        for i in counter:
+            path = paths[i % len(paths)]
+            start = time.perf_counter()
+            response = await client.get(path, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            wire_bytes += response.num_bytes_downloaded
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rps": total / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "errors": errors,
+        "bytes_per_req": wire_bytes / total,
+    }
+
+
+async def bench(args) -> list:
+    headers = dict(header.split(":", 1) for header in args.header)
+    headers = {key.strip(): value.strip() for key, value in headers.items()}
+    results = []
+    for config in args.config or [""]:
+        server = start_server(args.app_dir, args.port, parse_config(config))
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=30) as client:
+                await wait_until_ready(client)
+                await run_load(client, args.path, min(args.requests, 100), args.concurrency, headers)  # Warm up
+                cpu_before = psutil.Process(server.pid).cpu_times() if psutil else None
+                result = await run_load(client, args.path, args.requests, args.concurrency, headers)
+                if cpu_before:
+                    cpu_after = psutil.Process(server.pid).cpu_times()
+                    cpu = (cpu_after.user + cpu_after.system) - (cpu_before.user + cpu_before.system)
+                    result["cpu_ms_per_req"] = cpu * 1000 / args.requests
+                results.append((config or "default", result))
+        finally:
+            server.terminate()
+            server.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app-dir", required=True, help="Directory of the app to start, e.g. ecommerce-rdb")
+    parser.add_argument("--config", action="append", help="Environment for one run, e.g. DB_ASYNC=true")
+    parser.add_argument("--path", action="append", required=True, help="Path to request, repeat to mix several")
+    parser.add_argument("--header", action="append", default=[], help="Extra request header, e.g. 'Accept-Encoding: gzip'")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    results = asyncio.run(bench(args))
+    baseline = results[0][1]
+    for config, result in results:
+        if result is not baseline:
+            result["bytes_saved_pct"] = 100 * (1 - result["bytes_per_req"] / baseline["bytes_per_req"]) if baseline["bytes_per_req"] else 0.0
+            if "cpu_ms_per_req" in result:
+                result["cpu_ms_delta"] = result["cpu_ms_per_req"] - baseline["cpu_ms_per_req"]
+        stats = "  ".join(f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}" for key, value in result.items())
+        print(f"{config:<40} {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, Optional, Sequence
+import numpy as np
+import time
+import os
+
+CATALOG_CACHE_SIZE = 1024  # Maximum number of cached catalog responses
+CATALOG_CACHE_TTL = 60  # Seconds before a cached catalog response expires
+USER_CACHE_SIZE = 4096  # Maximum number of cached authenticated principals
+USER_CACHE_TTL = 300  # Seconds before a cached principal is loaded again
+ANSWER_CACHE_SIZE = 512  # Maximum number of cached FAQ answers per tier
+ANSWER_CACHE_TTL = 3600  # Seconds before a cached FAQ answer is generated again
+ANSWER_SIMILARITY_THRESHOLD = 0.92  # Cosine similarity from which a cached answer is reused for another prompt
+
+# Cache-Control sent by each catalog route, clients revalidate with If-None-Match
+CATALOG_CACHE_CONTROL = {
+    "products": os.getenv("PRODUCTS_CACHE_CONTROL", "no-cache"),
+    "product": os.getenv("PRODUCT_CACHE_CONTROL", "no-cache"),
+    "search": os.getenv("SEARCH_CACHE_CONTROL", "no-cache"),
+}
+
+class TTLCache:
+    """In-process LRU cache with a time-to-live per entry and hit-rate stats."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0  # Bumped on every invalidation
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value, or None when it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, version: Optional[int] = None):
+        """Store a value. Pass the version read before loading it so a value loaded before an invalidation is dropped."""
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys: Hashable):
+        """Drop the given entries."""
+        with self._lock:
+            self.version += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def invalidate(self, namespace: Optional[str] = None):
+        """Drop every entry whose key starts with namespace, or everything when no namespace is given."""
+        with self._lock:
+            self.version += 1
+            if namespace is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == namespace]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+class SemanticCache(TTLCache):
+    """TTLCache that is also looked up by embedding, the most similar entry above a cosine similarity threshold is a hit."""
+
+    def __init__(self, maxsize: int, ttl: float, threshold: float):
+        super().__init__(maxsize, ttl)
+        self.threshold = threshold
+
+    def get_similar(self, vector: Sequence[float]) -> Optional[Any]:
+        """Return the value of the most similar live entry, or None when no entry clears the threshold."""
+        query = unit_vector(vector)
+        with self._lock:
+            now = time.monotonic()
+            for key in [key for key, entry in self._entries.items() if entry[0] < now]:
+                del self._entries[key]
+            if self._entries:
+                keys = list(self._entries)
+                scores = np.stack([self._entries[key][1][0] for key in keys]) @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.hits += 1
+                    return self._entries[keys[best]][1][1]
+            self.misses += 1
+            return None
+
+    def set_similar(self, key: Hashable, vector: Sequence[float], value: Any, version: Optional[int] = None):
+        """Store a value under key along with its embedding."""
+        self.set(key, (unit_vector(vector), value), version)
+
+def unit_vector(vector: Sequence[float]) -> np.ndarray:
+    """Scale a vector to unit length, so dot products are cosine similarities."""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+# Cache of already serialized product and product listing responses
+catalog_cache = TTLCache(maxsize=CATALOG_CACHE_SIZE, ttl=CATALOG_CACHE_TTL)
+
+def invalidate_products(*product_ids):
+    """Drop the cached responses of the given products and every cached listing."""
+    catalog_cache.delete(*[("product", str(product_id)) for product_id in product_ids])
+    catalog_cache.invalidate("products")
+
+# Cache of authenticated principals keyed on the token subject (the user email)
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+def invalidate_user(*emails):
+    """Drop the cached principals of the given emails."""
+    user_cache.delete(*emails)
+
+# Two tier cache of FAQ chat answers: normalized prompts, then prompts with a similar embedding
+answer_cache = TTLCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+semantic_answer_cache = SemanticCache(maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_SIMILARITY_THRESHOLD)
+
+def invalidate_answers():
+    """Drop every cached FAQ answer, they may quote an outdated FAQ."""
+    answer_cache.invalidate()
+    semantic_answer_cache.invalidate()
@@ -0,0 +1,57 @@
+from database import UserDocument, ProductDocument, OrderDocument, init_db
+from bson import ObjectId
+from datetime import datetime, timezone
+import asyncio
+import sys
+
+
+# Hot queries of the routes, as (route, collection, filter, sort)
+def hot_queries() -> list[tuple]:
+    now = datetime.now(timezone.utc)
+    last_id = ObjectId()
+    queries = [
+        ("POST /auth/token", UserDocument, {"email": "admin@gmail.com"}, None),
+        ("GET /auth/me", UserDocument, {"email": "admin@gmail.com"}, None),
+        ("GET /store/my-orders", OrderDocument, {"user_id": ObjectId()}, None),
+    ]
+    for field, value in (("name", "m"), ("created_at", now)):
+        for direction in (1, -1):
+            label = f"GET /store/products/?order_by={'-' if direction == -1 else ''}{field}"
+            sort = [(field, direction), ("_id", direction)]
+            op = "$lt" if direction == -1 else "$gt"
+            seek = {"$or": [{field: {op: value}}, {field: value, "_id": {op: last_id}}]}
+            queries.append((label, ProductDocument, {"stock": {"$gt": 0}}, sort))
+            queries.append((label + "&cursor=...", ProductDocument, {"$and": [{"stock": {"$gt": 0}}, seek]}, sort))
+    return queries
+
+
+# Function to collect the stages of a winning plan
+def plan_stages(plan: dict) -> list[str]:
+    stages = [plan["stage"]]
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            stages += plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+
+async def check_indexes() -> bool:
+    await init_db()
+
+    ok = True
+    for route, document, query, sort in hot_queries():
+        cursor = document.get_motor_collection().find(query).limit(10)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+        status = "COLLSCAN" if "COLLSCAN" in stages else "ok"
+        ok = ok and status == "ok"
+        print(f"{status:<9} {route:<50} {' <- '.join(stages)}")
+    return ok
+
+
+# ✅ Entry point
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(check_indexes()) else 1)
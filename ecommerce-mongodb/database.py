@@ -1,10 +1,15 @@
-from beanie import Document, init_beanie, PydanticObjectId
+from beanie import Document, init_beanie, PydanticObjectId, after_event, Insert, Replace, Save, SaveChanges, Update, Delete
 from pydantic import Field, EmailStr
-from typing import Optional, List, Literal
+from typing import Optional, List, Literal, Dict, AsyncIterator
 import motor.motor_asyncio
-from schemas import OrderItemOut, OrderItem, OrderOut
+from motor.motor_asyncio import AsyncIOMotorClientSession
+from beanie.operators import In
+from pymongo import UpdateOne, IndexModel, ASCENDING
+from pymongo.errors import BulkWriteError
+from schemas import OrderItem, OrderOut
 from datetime import datetime, timezone
 from fastapi import HTTPException
+from cache import invalidate_products, invalidate_user
 
 MONGO_URI = "mongodb://localhost:27017"  # MongoDB URI  
 
@@ -16,9 +21,18 @@ class UserDocument(Document):
 
     class Settings:
         collection = "users"  # MongoDB collection name
+        indexes = [
+            # Looked up on every login and authenticated request, unique so duplicate registrations fail
+            IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+        ]
+
+    @after_event(Insert, Replace, Save, SaveChanges, Update, Delete)
+    def invalidate_cache(self):
+        """Drop the cached principal whenever the user record changes."""
+        invalidate_user(self.email)
 
 class ProductDocument(Document):
-    name: str = Field(max_length=100, index=True)
+    name: str = Field(max_length=100)
     price: float = Field(..., gt=0, description="Price must be greater than 0")
     stock: int = 10 # Default stock to 10
     description: Optional[str] = None
@@ -28,12 +42,28 @@ class ProductDocument(Document):
 
     class Settings:
         collection = "products"  # MongoDB collection name
+        # The listing filters on stock > 0 and sorts on (name or created_at, _id). Sort keys come first, then the
+        # stock range, so the index returns documents already ordered and filters stock from the index keys
+        indexes = [
+            IndexModel([("name", ASCENDING), ("_id", ASCENDING), ("stock", ASCENDING)], name="name_id_stock"),
+            IndexModel([("created_at", ASCENDING), ("_id", ASCENDING), ("stock", ASCENDING)], name="created_at_id_stock"),
+        ]
     
+    @classmethod
+    async def bulk_insert(cls, products: List["ProductDocument"]) -> Dict[int, str]:
+        """Insert a batch of products unordered, returns the error of each failed product by batch index."""
+        try:
+            await cls.insert_many(products, ordered=False)
+        except BulkWriteError as e:
+            return {error["index"]: error["errmsg"] for error in e.details.get("writeErrors", [])}
+        return {}
+
     async def update_stock(self, quantity: int):
         """Update stock when a product is purchased."""
         self.stock -= quantity
         self.updated_at = datetime.now(timezone.utc)
         await self.save()
+        invalidate_products(self.id)  # Drop the cached catalog responses showing the old stock
 
 
 # Beanie model for Order (database interaction)
@@ -46,64 +76,114 @@ class OrderDocument(Document):
 
     class Settings:
         collection = "orders"  # MongoDB collection name
+        indexes = [
+            # Order history of a user
+            IndexModel([("user_id", ASCENDING), ("created_at", ASCENDING)], name="user_id_created_at"),
+        ]
     
-    @property
-    async def total_price(self) -> float:
-        """Calculate total price of the order."""
-        total = 0.0
-        for item in self.items:
-            product = await ProductDocument.get(item.product_id)
-            if product:
-                total += product.price * item.quantity
-            else:
-                raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
-        return round(total, 2)
-    
-    @property
-    async def items_list(self) -> List[OrderItemOut]:
-        """Get full item list with product details."""
-        items = []
-        for item in self.items:
-            product = await ProductDocument.get(item.product_id)
-            if product:
-                items.append(OrderItemOut(product=product, quantity=item.quantity))
-            else:
-                raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
-        return items
-
     async def update_status(self, status: str):
         """Update order status."""
         self.status = status
         self.updated_at = datetime.now(timezone.utc)
         await self.save()
     
-    async def update_stock(self):
-        """Update stock for each product in the order."""
+    async def update_stock(self, session: Optional[AsyncIOMotorClientSession] = None) -> List[dict]:
+        """Decrement stock for all items with a single bulk_write and return a per-line failure report."""
+        # Merge repeated lines so each product gets a single $inc
+        quantities = {}
+        for item in self.items:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+
+        # Each update only matches when enough stock is left, so concurrent checkouts cannot oversell
+        now = datetime.now(timezone.utc)
+        operations = [
+            UpdateOne({"_id": product_id, "stock": {"$gte": quantity}},
+                      {"$inc": {"stock": -quantity}, "$set": {"updated_at": now}})
+            for product_id, quantity in quantities.items()
+        ]
+        result = await ProductDocument.get_motor_collection().bulk_write(operations, ordered=False, session=session)
+        if result.matched_count == len(operations):
+            return []
+
+        # Some lines did not apply, read the committed stock to report which ones
+        products = await ProductDocument.find(In(ProductDocument.id, list(quantities))).to_list()
+        available = {product.id: product.stock for product in products}
+        failures = []
+        for product_id, quantity in quantities.items():
+            if product_id not in available:
+                failures.append({"product_id": str(product_id), "requested": quantity, "available": 0, "reason": "Product not found"})
+            elif available[product_id] < quantity:
+                failures.append({"product_id": str(product_id), "requested": quantity, "available": available[product_id], "reason": "Not enough stock"})
+        return failures or [{"reason": "Stock changed during checkout, please retry"}]
+
+    async def place(self):
+        """Reserve stock and insert the order in one transaction."""
+        client = self.get_motor_collection().database.client
+        async with await client.start_session() as session:
+            async with session.start_transaction():
+                failures = await self.update_stock(session=session)
+                if failures:
+                    # Raising inside the transaction aborts it, so no stock is decremented
+                    raise HTTPException(status_code=400, detail={"message": "Order could not be placed", "failures": failures})
+                await self.insert(session=session)
+        # The transaction is committed, cached catalog responses show the old stock
+        invalidate_products(*(item.product_id for item in self.items))
+    
+    @staticmethod
+    async def fetch_products(orders: List["OrderDocument"]) -> Dict[PydanticObjectId, ProductDocument]:
+        """Fetch every product referenced by the given orders with a single $in query."""
+        product_ids = list({item.product_id for order in orders for item in order.items})
+        products = await ProductDocument.find(In(ProductDocument.id, product_ids)).to_list()
+        return {product.id: product for product in products}
+
+    def build_order_out(self, products: Dict[PydanticObjectId, ProductDocument]) -> dict:
+        """Build the OrderOut data from already fetched products, computing the total in the same pass.
+
+        Plain data is returned so that it is validated only once, by whoever serializes it.
+        """
+        total = 0.0
+        items_list = []
         for item in self.items:
-            product = await ProductDocument.get(item.product_id)
+            product = products.get(item.product_id)
             if not product:
                 raise HTTPException(status_code=404, detail=f"Product {item.product_id} not found")
+            total += product.price * item.quantity
+            items_list.append({"product": product, "quantity": item.quantity})
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "items_list": items_list,
+            "total_price": round(total, 2),
+            "status": self.status,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
 
-            if product.stock < item.quantity:
-                raise HTTPException(status_code=400, detail=f"Not enough stock for product: {product.name}")
-        
-            await product.update_stock(item.quantity)
-    
     async def get_order_out(self) -> OrderOut:
         """Convert OrderDocument to OrderOut."""
-        total_price = await self.total_price
-        items_list = await self.items_list
-        return OrderOut(
-            id=self.id,
-            items_list=items_list,
-            total_price=total_price,
-            status=self.status,
-            created_at=self.created_at,
-            updated_at=self.updated_at
-        )
+        products = await self.fetch_products([self])
+        return OrderOut.model_validate(self.build_order_out(products))
+
+    @classmethod
+    async def get_orders_out(cls, orders: List["OrderDocument"]) -> List[dict]:
+        """Build the OrderOut data of a list of orders with one product query for the whole list."""
+        products = await cls.fetch_products(orders)
+        return [order.build_order_out(products) for order in orders]
+
+async def stream_partitions(query, batch_size: int) -> AsyncIterator[list]:
+    """Yield the documents of a query in partitions while iterating its cursor."""
+    partition = []
+    async for document in query:
+        partition.append(document)
+        if len(partition) >= batch_size:
+            yield partition
+            partition = []
+    if partition:
+        yield partition
 
 async def init_db():
     """Initialize the database connection and Beanie ORM."""
     client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_URI)
     database = client["ecommerce"]  # Database name
-    await init_beanie(database, document_models=[ProductDocument, UserDocument, OrderDocument])  # Initialize Beanie with the database and models
+    # Initialize Beanie with the database and models, this also creates the indexes declared in each Settings
+    await init_beanie(database, document_models=[ProductDocument, UserDocument, OrderDocument])
@@ -1,22 +1,34 @@
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from database import init_db
 from contextlib import asynccontextmanager
-from routes.auth import router as auth_router
+from routes.auth import router as auth_router, admin_depends
 from routes.store import router as store_router
-from routes.chat import router as chat_router
+from routes.chat import router as chat_router, chat_stats
 from logger_config import logger
+from cache import catalog_cache, answer_cache, semantic_answer_cache
+from compression import CompressionMiddleware, RESPONSE_COMPRESSION, compression_stats
+from upload_limit import UploadLimitMiddleware, FORM_OVERHEAD
+from static_files import UploadFiles
+from utils import backfill_variants, MAX_IMAGE_SIZE
 import uvicorn
 import os
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_db()
+    backfill_variants()  # Queued on the image executor, startup doesn't wait for the rendering
     yield
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)  # orjson for routes returning plain data
+
+# Refuse oversized image uploads before the multipart body is spooled
+app.add_middleware(UploadLimitMiddleware, max_body_size=MAX_IMAGE_SIZE + FORM_OVERHEAD)
+
+# Compress responses, streamed chunks are flushed one by one
+if RESPONSE_COMPRESSION:
+    app.add_middleware(CompressionMiddleware)
 
 # Enable CORS
 app.add_middleware(
@@ -25,12 +37,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],  # Let browsers read the pagination cursor and validators
 )
 
-# Static files directory for image uploads
+# Static files directory for image uploads, served with immutable caching
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+app.mount("/uploads", UploadFiles(directory=UPLOAD_DIR), name="uploads")
 
 # Custom exception handler for HTTPException
 @app.exception_handler(Exception)
@@ -46,6 +59,14 @@ app.include_router(auth_router)
 app.include_router(store_router)
 app.include_router(chat_router)
 
+# Internal runtime stats, admins only and hidden from the public API docs
+@app.get("/internal/stats", include_in_schema=False)
+def internal_stats(current_user: admin_depends):
+    return {"catalog_cache": catalog_cache.stats(),
+            "compression": compression_stats,
+            "answer_cache": {"exact": answer_cache.stats(), "semantic": semantic_answer_cache.stats()},
+            "chat": chat_stats()}
+
 
 if __name__ == "__main__":
     uvicorn.run("main:app", log_level="info", reload=True)
\ No newline at end of file
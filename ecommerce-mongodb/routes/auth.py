@@ -1,13 +1,18 @@
-from utils import create_access_token, verify_password, hash_password, decode_access_token
+from utils import create_access_token, verify_password, hash_password, decode_access_token, run_password_task
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi import Depends, HTTPException, APIRouter, status
 from database import UserDocument
 from schemas import Token, UserOut
+from cache import user_cache
 import jwt
+import os
 from typing import Annotated
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
+# Emails allowed to use the admin routes, comma separated
+ADMIN_EMAILS = [email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()]
+
 # User authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
@@ -21,13 +26,25 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         if username is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
         
+        # Serve the principal from the cache for repeat callers
+        user = user_cache.get(username)
+        if user is not None:
+            return user
+
         # Fetch the user from the database
-        user = await UserDocument.find_one(UserDocument.email == username)
-        if user is None:
+        version = user_cache.version
+        user_doc = await UserDocument.find_one(UserDocument.email == username)
+        if user_doc is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
-        
+
+        # Cache a detached copy, concurrent requests must not share the live document
+        user = UserOut.model_validate(user_doc, from_attributes=True)
+        user_cache.set(username, user, version)
         return user
 
+    except HTTPException:
+        raise
+
     except jwt.PyJWTError as e:
         # Catch JWT decoding errors and provide a custom message
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
@@ -38,6 +55,14 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
 
 user_depends = Annotated[UserOut, Depends(get_current_user)]
 
+async def get_current_admin(current_user: user_depends) -> UserOut:
+    # Admin routes are limited to the configured emails
+    if current_user.email.lower() not in {email.lower() for email in ADMIN_EMAILS}:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
+admin_depends = Annotated[UserOut, Depends(get_current_admin)]
+
 @router.post("/token", response_model=Token)
 async def login(form_data: OAuth2PasswordRequestForm = Depends()):
     try:
@@ -45,13 +70,17 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends()):
         user = await UserDocument.find_one(UserDocument.email == form_data.username)
         
         # Handle invalid credentials
-        if not user or not verify_password(form_data.password, user.password_hash):
+        if not user or not await run_password_task(verify_password, form_data.password, user.password_hash):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect username or password")
         
         # Generate access token
         access_token = create_access_token(data={"sub": user.email})
         return access_token
     
+    except HTTPException:
+        # Keep 400s and the 503 raised when the password executor is saturated
+        raise
+
     except Exception as e:
         # Catch any unexpected errors (e.g., database failure)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred during login")
@@ -65,7 +94,7 @@ async def register(username: str, email: str, password: str):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
         
         # Hash the password
-        hashed_password = hash_password(password)
+        hashed_password = await run_password_task(hash_password, password)
         
         # Create and insert the new user
         user = UserDocument(username=username, email=email, password_hash=hashed_password)
@@ -73,6 +102,10 @@ async def register(username: str, email: str, password: str):
         
         return user
 
+    except HTTPException:
+        # Keep 400s and the 503 raised when the password executor is saturated
+        raise
+
     except Exception as e:
         # Handle unexpected errors (e.g., database failure)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred during registration")
@@ -1,12 +1,46 @@
-from fastapi import APIRouter, HTTPException, Path, Query, Form, UploadFile, File
-from schemas import ProductOut, OrderIn, OrderOut
-from database import ProductDocument, OrderDocument
-from routes.auth import user_depends
+from fastapi import APIRouter, HTTPException, Path, Query, Form, UploadFile, File, Response, Request
+from schemas import ProductIn, ProductOut, OrderIn, OrderOut, OrderExport
+from database import ProductDocument, OrderDocument, stream_partitions
+from routes.auth import user_depends, admin_depends
+from cache import catalog_cache, invalidate_products, CATALOG_CACHE_CONTROL
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter, ValidationError
 from typing import List, Annotated, Literal, Optional
-from utils import save_image
+from utils import save_image, encode_cursor, decode_cursor, import_format, iter_import_rows, IMPORT_BATCH_SIZE, IMPORT_MAX_ERRORS, encode_export, flatten_order, EXPORT_BATCH_SIZE, EXPORT_MEDIA_TYPES
+from beanie import PydanticObjectId
+from bson.errors import InvalidId
+from datetime import datetime
+import hashlib
 
 router = APIRouter(prefix="/store", tags=["store"])
 
+product_list_adapter = TypeAdapter(List[ProductOut])
+order_list_adapter = TypeAdapter(List[OrderOut])
+
+def json_response(adapter: TypeAdapter, data) -> Response:
+    """Validate ORM objects in a single pass and dump them straight to JSON bytes, skipping response_model validation."""
+    return Response(content=adapter.dump_json(adapter.validate_python(data)), media_type="application/json")
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def catalog_response(request: Request, route: str, body: bytes, next_cursor: Optional[str] = None) -> Response:
+    """Wrap an already serialized catalog body, skipping response_model validation.
+
+    The ETag is a hash of the body, so it changes exactly when the payload does and a
+    matching If-None-Match gets an empty 304.
+    """
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL[route]}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # Route to create a new product
 @router.post("/products/", response_model=ProductOut)
 async def create_product(current_user: user_depends,
@@ -18,46 +52,134 @@ async def create_product(current_user: user_depends,
     try:
         image_url = None
         if image:
-            image_url = save_image(image)  # Save the image to the server
+            image_url = await save_image(image)  # Stream the image to the server
         product_doc = ProductDocument(name=name, price=price, description=description, stock=stock, image_url=image_url)
         await product_doc.insert()  # Insert product into MongoDB
+        invalidate_products(product_doc.id)  # Cached listings don't include the new product yet
         return product_doc
+    except HTTPException:
+        raise  # Rejected image
     except Exception as e:
         # Handle any unexpected errors during insert
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+# Route to import products in bulk from a streamed NDJSON or CSV body
+@router.post("/products/bulk")
+async def import_products(request: Request, current_user: user_depends,
+                        batch_size: Annotated[int, Query(gt=0, le=5000)] = IMPORT_BATCH_SIZE):
+    fmt = import_format(request.headers.get("content-type"))
+    if fmt is None:
+        raise HTTPException(status_code=415, detail="Send the products as application/x-ndjson or text/csv")
+    report = {"inserted": 0, "failed": 0, "errors": []}
+    batch = []
+
+    def reject(row: int, errors: List[str]):
+        report["failed"] += 1
+        if len(report["errors"]) < IMPORT_MAX_ERRORS:
+            report["errors"].append({"row": row, "errors": errors})
+
+    async def flush():
+        try:
+            failures = await ProductDocument.bulk_insert([product for _, product in batch])
+        except Exception as e:
+            failures = {index: f"Batch insert failed: {str(e)}" for index in range(len(batch))}
+        for index, error in sorted(failures.items()):
+            reject(batch[index][0], [error])
+        report["inserted"] += len(batch) - len(failures)
+        batch.clear()
+
+    try:
+        # Rows are parsed as the body arrives, at most one batch is held in memory
+        async for row, fields in iter_import_rows(request.stream(), fmt):
+            if isinstance(fields, str):
+                reject(row, [fields])
+                continue
+            try:
+                product = ProductDocument(**ProductIn.model_validate(fields).model_dump(exclude_none=True))
+            except ValidationError as e:
+                reject(row, [f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()])
+                continue
+            batch.append((row, product))
+            if len(batch) >= batch_size:
+                await flush()
+        if batch:
+            await flush()
+    finally:
+        if report["inserted"]:
+            invalidate_products()  # Cached listings don't include the imported products yet
+    return report
+
 # Route to get all products in the catalog
 @router.get("/products/", response_model=List[ProductOut])
-async def get_products(offset: Annotated[int, Query(ge=0)] = 0,
+async def get_products(request: Request,
+                offset: Annotated[int, Query(ge=0)] = 0,
                 limit: Annotated[int, Query(gt=0)] = 10,
-                order_by: Literal["name", "-name", "created_at", "-created_at"] = "name"):
+                order_by: Literal["name", "-name", "created_at", "-created_at"] = "name",
+                cursor: Annotated[Optional[str], Query(description="Cursor from the X-Next-Cursor header of the previous page, takes precedence over offset")] = None):
+    # Serve the already serialized page when it is cached
+    key = ("products", order_by, limit, cursor or offset)
+    cached = catalog_cache.get(key)
+    if cached is not None:
+        return catalog_response(request, "products", *cached)
+    version = catalog_cache.version
+
+    # Map order_by string to Beanie field sort, the _id breaks ties so the ordering is total
+    sort_field = order_by.lstrip("-")
+    sort_direction = -1 if order_by.startswith("-") else 1
+
+    # Get products with positive stock
+    find_query = ProductDocument.find(ProductDocument.stock > 0)
+    if cursor:
+        try:
+            sort_value, last_id = decode_cursor(cursor, order_by)
+            if sort_field == "created_at":
+                sort_value = datetime.fromisoformat(sort_value)
+            last_id = PydanticObjectId(last_id)
+        except (TypeError, ValueError, InvalidId) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        # Seek past the last document of the previous page instead of skipping documents
+        op = "$lt" if sort_direction == -1 else "$gt"
+        find_query = find_query.find({"$or": [{sort_field: {op: sort_value}}, {sort_field: sort_value, "_id": {op: last_id}}]})
+    else:
+        find_query = find_query.skip(offset)
     try:
-        # Map order_by string to Beanie field sort
-        sort_field = order_by.lstrip("-")
-        sort_direction = -1 if order_by.startswith("-") else 1
-        # Get products with positive stock
-        products = await ProductDocument.find(ProductDocument.stock > 0).sort((sort_field, sort_direction)).skip(offset).limit(limit).to_list()
-        return products
+        products = await find_query.sort((sort_field, sort_direction), ("_id", sort_direction)).limit(limit).to_list()
+        next_cursor = None
+        if len(products) == limit:
+            last = products[-1]
+            next_cursor = encode_cursor(order_by, getattr(last, sort_field), last.id)
+        body = product_list_adapter.dump_json(product_list_adapter.validate_python(products))
+        catalog_cache.set(key, (body, next_cursor), version)
+        return catalog_response(request, "products", body, next_cursor)
     except Exception as e:
         # Handle any unexpected errors during query
         raise HTTPException(status_code=500, detail=f"Error fetching products: {str(e)}")
 
 # Route to get a specific product by ID
 @router.get("/products/{product_id}", response_model=ProductOut)
-async def get_product(product_id: Annotated[str, Path(title="The ID of the product to retrieve")]):
+async def get_product(request: Request, product_id: Annotated[PydanticObjectId, Path(title="The ID of the product to retrieve")]):
+    # Serve the already serialized product when it is cached, keyed by the parsed id as invalidate_products does
+    key = ("product", str(product_id))
+    body = catalog_cache.get(key)
+    if body is not None:
+        return catalog_response(request, "product", body)
+    version = catalog_cache.version
     try:
         # Try to fetch the product by ID
         product = await ProductDocument.get(product_id)
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
-        return product
+        body = ProductOut.model_validate(product).model_dump_json().encode()
+        catalog_cache.set(key, body, version)
+        return catalog_response(request, "product", body)
     except Exception as e:
         # Handle any unexpected errors during query
         raise HTTPException(status_code=500, detail=f"Error fetching product: {str(e)}")
 
 # Route to search products by name or price range
 @router.get("/search", response_model=List[ProductOut])
-async def search_products(query: Annotated[Optional[str], Query(max_length=50)] = None,
+async def search_products(request: Request,
+                    query: Annotated[Optional[str], Query(max_length=50)] = None,
                     min_price: Annotated[Optional[float], Query(ge=0)] = None,
                     max_price: Annotated[Optional[float], Query(gt=0)] = None):
     try:
@@ -72,7 +194,8 @@ async def search_products(query: Annotated[Optional[str], Query(max_length=50)]
 
         # Fetch products matching the search criteria
         products = await ProductDocument.find(ProductDocument.stock > 0).find(search_query).to_list()
-        return products
+        body = product_list_adapter.dump_json(product_list_adapter.validate_python(products))
+        return catalog_response(request, "search", body)
     except Exception as e:
         # Handle any unexpected errors during query
         raise HTTPException(status_code=500, detail=f"Error fetching products: {str(e)}")
@@ -85,13 +208,13 @@ async def create_order(order: OrderIn, current_user: user_depends):
         # Create a new OrderDocument
         order_doc = OrderDocument(**order.model_dump(), user_id=current_user.id)
         
-        # Update stock before inserting order
-        await order_doc.update_stock()
-        
-        # Insert the order into the database
-        await order_doc.insert()
+        # Reserve stock and insert the order in a single transaction
+        await order_doc.place()
         order_out = await order_doc.get_order_out()
-        return order_out
+        return Response(content=order_out.model_dump_json(), media_type="application/json")  # Already validated
+    except HTTPException:
+        # Keep the per-line failure report from the stock reservation
+        raise
     except Exception as e:
         # Handle any unexpected errors during order creation
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
@@ -100,7 +223,27 @@ async def create_order(order: OrderIn, current_user: user_depends):
 async def get_orders(current_user: user_depends):
     try:
         orders = await OrderDocument.find(OrderDocument.user_id == current_user.id).to_list()
-        orders_out = [await order.get_order_out() for order in orders]
-        return orders_out
+        # Resolve the products of all orders in one query
+        orders_out = await OrderDocument.get_orders_out(orders)
+        return json_response(order_list_adapter, orders_out)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching orders: {str(e)}")
+
+# Route to export the whole catalog as NDJSON or CSV, streamed from the cursor
+@router.get("/export/products")
+async def export_products(current_user: user_depends, format: Literal["ndjson", "csv"] = "ndjson"):
+    query = ProductDocument.find_all(batch_size=EXPORT_BATCH_SIZE).sort("+_id")
+    partitions = stream_partitions(query, EXPORT_BATCH_SIZE)
+    return StreamingResponse(encode_export(partitions, ProductOut, format), media_type=EXPORT_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="products.{format}"'})
+
+# Route to export every order as NDJSON or CSV (one line per item), streamed from the cursor
+@router.get("/export/orders")
+async def export_orders(current_user: admin_depends, format: Literal["ndjson", "csv"] = "ndjson"):
+    async def order_partitions():
+        query = OrderDocument.find_all(batch_size=EXPORT_BATCH_SIZE).sort("+_id")
+        async for orders in stream_partitions(query, EXPORT_BATCH_SIZE):
+            # Resolve the products of each partition in one query
+            yield await OrderDocument.get_orders_out(orders)
+    return StreamingResponse(encode_export(order_partitions(), OrderExport, format, flatten_order), media_type=EXPORT_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="orders.{format}"'})
@@ -1,14 +1,29 @@
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, Field, computed_field, EmailStr
 from beanie import PydanticObjectId
 from typing import List, Optional, Literal
 from datetime import datetime, timezone
 
+# Responsive variants generated for every uploaded image, longest side in pixels
+IMAGE_VARIANTS = {"thumb": 200, "medium": 600}
+
+# Urls of the variants stored in uploads, filled by generate_variants and backfill_variants so serializing never touches the disk
+rendered_variants: set[str] = set()
+
+# Function to derive the url of an image variant, variants sit next to the original as <hash>_<variant>.webp
+def image_variant_url(image_url: Optional[str], variant: str) -> Optional[str]:
+    if not image_url:
+        return None
+    variant_url = f"{image_url.rsplit('.', 1)[0]}_{variant}.webp"
+    # Not rendered yet, failed, or uploaded before variants existed: link the original instead of a 404
+    return variant_url if variant_url in rendered_variants else image_url
+
 class Token(BaseModel):
     access_token: str = Field(..., description="JWT access token")
     token_type: str = Field(..., description="Type of the token, usually 'bearer'")
 
 
 class UserOut(BaseModel):
+    id: Optional[PydanticObjectId] = None
     username: str
     email: EmailStr
     created_at: datetime
@@ -17,7 +32,7 @@ class ProductIn(BaseModel):
     name: str
     price: float = Field(..., gt=0, description="Price must be greater than 0")
     stock: Optional[int] = Field(default=10, ge=0, description="Stock must be greater than or equal to 0")
-    description: Optional[str]
+    description: Optional[str] = None
 
     class Config:
         from_attributes = True  # Enable ORM mode to read data as dict
@@ -32,6 +47,16 @@ class ProductOut(BaseModel):
     created_at: datetime
     updated_at: Optional[datetime]
 
+    @computed_field
+    @property
+    def thumbnail_url(self) -> Optional[str]:
+        return image_variant_url(self.image_url, "thumb")
+
+    @computed_field
+    @property
+    def medium_url(self) -> Optional[str]:
+        return image_variant_url(self.image_url, "medium")
+
     class Config:
         from_attributes = True  # Enable ORM mode to read data as dict
 
@@ -67,6 +92,14 @@ class OrderOut(BaseModel):
     class Config:
         from_attributes = True
 
+class OrderExport(OrderOut):
+    user_id: PydanticObjectId
+
 class ChatRequest(BaseModel):
     prompt: str
 
+class FAQMatch(BaseModel):
+    question: str
+    answer: str
+    score: float = Field(..., description="Cosine similarity between the query and the FAQ question, 1 is identical")
+
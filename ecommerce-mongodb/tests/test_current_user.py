@@ -0,0 +1,34 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+from beanie import PydanticObjectId
+from cache import user_cache
+from routes import auth
+from schemas import UserOut
+
+
+@pytest.fixture
+def user_doc(monkeypatch):
+    doc = SimpleNamespace(id=PydanticObjectId(), username="buyer", email="buyer@example.com",
+                          password_hash="x", created_at=datetime.now(timezone.utc))
+
+    async def find_one(*args):
+        return doc
+
+    monkeypatch.setattr(auth, "decode_access_token", lambda token: {"sub": doc.email})
+    monkeypatch.setattr(auth, "UserDocument", SimpleNamespace(email="email", find_one=find_one))
+    user_cache.invalidate()
+    yield doc
+    user_cache.invalidate()
+
+
+def test_cached_principal_is_a_detached_copy(user_doc):
+    first = asyncio.run(auth.get_current_user("token"))
+    user_doc.username = "renamed"
+    second = asyncio.run(auth.get_current_user("token"))
+
+    assert isinstance(first, UserOut) and first is not user_doc
+    assert second is first  # Served from the cache
+    assert second.username == "buyer" and second.id == user_doc.id
+    assert not hasattr(second, "password_hash")
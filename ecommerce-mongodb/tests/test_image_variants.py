@@ -0,0 +1,37 @@
+import os
+import pytest
+from PIL import Image
+import utils
+from schemas import rendered_variants, image_variant_url
+
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "UPLOAD_DIR", str(tmp_path))
+    rendered_variants.clear()
+    yield tmp_path
+    rendered_variants.clear()
+
+
+def test_generate_variants_registers_the_rendered_files(upload_dir):
+    Image.new("RGB", (800, 400), "red").save(upload_dir / "abc.png")
+
+    utils.generate_variants(str(upload_dir / "abc.png"))
+
+    assert sorted(os.listdir(upload_dir)) == ["abc.png", "abc_medium.webp", "abc_thumb.webp"]
+    assert image_variant_url("/uploads/abc.png", "thumb") == "/uploads/abc_thumb.webp"
+    assert image_variant_url("/uploads/abc.png", "medium") == "/uploads/abc_medium.webp"
+
+
+def test_backfill_registers_stored_variants_and_renders_the_missing_ones(upload_dir):
+    Image.new("RGB", (800, 400), "red").save(upload_dir / "old.png")
+    Image.new("RGB", (800, 400), "blue").save(upload_dir / "new.png")
+    utils.generate_variants(str(upload_dir / "new.png"))
+    rendered_variants.clear()  # As after a restart
+
+    utils.backfill_variants()
+    assert "/uploads/new_thumb.webp" in rendered_variants
+    utils.image_executor.submit(lambda: None).result()  # The single image worker has rendered the queued variants
+
+    assert image_variant_url("/uploads/old.png", "thumb") == "/uploads/old_thumb.webp"
+    assert image_variant_url("/uploads/new.png", "medium") == "/uploads/new_medium.webp"
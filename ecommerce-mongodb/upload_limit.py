@@ -0,0 +1,45 @@
+from fastapi import HTTPException, status
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+FORM_OVERHEAD = 64 * 1024  # Bytes allowed on top of the image for boundaries, part headers and text fields
+
+
+class UploadLimitMiddleware:
+    """Reject multipart bodies larger than an image upload can be, before they are spooled to disk.
+
+    A declared Content-Length over the limit is answered with 413 without reading the body.
+    Bodies without one are counted as they arrive and stopped with 413 once they exceed it.
+    """
+
+    def __init__(self, app: ASGIApp, max_body_size: int):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        headers = Headers(scope=scope) if scope["type"] == "http" else None
+        if headers is None or not headers.get("content-type", "").startswith("multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+
+        detail = f"Request body exceeds the {self.max_body_size} bytes limit."
+        content_length = headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > self.max_body_size:
+            response = JSONResponse({"detail": detail}, status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    # Raised while the form is parsed, the route's exception handling answers 413
+                    raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
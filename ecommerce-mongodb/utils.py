@@ -1,11 +1,23 @@
 import jwt
 from datetime import datetime, timedelta, timezone
 from passlib.context import CryptContext
-from typing import Optional
-from schemas import Token
-from fastapi import UploadFile
+from typing import Optional, Callable, Union, List, AsyncIterator
+from schemas import Token, IMAGE_VARIANTS, rendered_variants
+from pydantic import BaseModel
+from logger_config import logger
+from PIL import Image, ImageOps
+from fastapi import UploadFile, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
 from uuid import uuid4
-import shutil
+import asyncio
+import hashlib
+import base64
+import codecs
+import csv
+import io
+import json
 import os
 
 # Secret key and algorithm
@@ -13,8 +25,27 @@ SECRET_KEY = "ae3f7120d9f1dbd60c423b7884cb88b9ed54290c3ef3b4d7c09bba58cd9a8c09"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 180
 
+# Password hashing settings, existing hashes keep verifying with the cost they were created with
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))  # Threads dedicated to bcrypt
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "16"))  # Calls allowed to wait for a thread
+
 # Password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# Dedicated executor so bcrypt never runs on the event loop or the request threadpool
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
+password_slots = BoundedSemaphore(PASSWORD_WORKERS + PASSWORD_QUEUE_LIMIT)
+
+# Image upload settings
+UPLOAD_DIR = "uploads"
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", str(5 * 1024 * 1024)))  # Bytes
+IMAGE_SIGNATURES = {b"\xff\xd8\xff": ".jpg", b"\x89PNG\r\n\x1a\n": ".png"}
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "1"))  # Threads rendering the image variants
+
+# Variants are rendered in the background so the upload request doesn't wait for them
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
 
 # Function to hash a password
 def hash_password(password: str) -> str:
@@ -24,6 +55,14 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+# Function to run a password call on the password executor, fails fast with a 503 when it is saturated
+async def run_password_task(fn: Callable, *args):
+    if not password_slots.acquire(blocking=False):
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many login attempts, please retry shortly", headers={"Retry-After": "1"})
+    future = password_executor.submit(fn, *args)
+    future.add_done_callback(lambda _: password_slots.release())
+    return await asyncio.wrap_future(future)
+
 # Function to create a JWT token
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> Token:
     to_encode = data.copy()
@@ -40,13 +79,250 @@ def decode_access_token(token: str) -> dict:
     payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     return payload
 
-# Function to save an image file
-def save_image(image: UploadFile) -> str:
-    ext = os.path.splitext(image.filename)[1]
-    if ext not in {".jpg", ".jpeg", ".png"}:
-        raise ValueError("Invalid image format. Only .jpg, .jpeg, and .png are allowed.")
-    filename = f"{uuid4().hex}{ext}"
-    file_path = os.path.join("uploads", filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
-    return f"/uploads/{filename}"
\ No newline at end of file
+# Function to detect the image type from its first bytes, the client supplied filename and content type are not trusted
+def sniff_image_type(head: bytes) -> Optional[str]:
+    for signature, ext in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return ext
+    return None
+
+# Function to remove a partially written upload
+def discard_upload(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# Function to flush an upload to disk and move it into place in one step, an identical image already stored is reused
+def commit_upload(buffer, tmp_path: str, file_path: str):
+    if os.path.exists(file_path):
+        buffer.close()
+        discard_upload(tmp_path)
+        return
+    buffer.flush()
+    os.fsync(buffer.fileno())
+    buffer.close()
+    os.replace(tmp_path, file_path)
+
+# Function to render the WebP variants of a stored image, existing variants are kept
+def generate_variants(file_path: str):
+    stem = os.path.splitext(file_path)[0]
+    with Image.open(file_path) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ("RGB", "RGBA"):
+            original = original.convert("RGBA")
+        for variant, size in IMAGE_VARIANTS.items():
+            variant_path = f"{stem}_{variant}.webp"
+            if not os.path.exists(variant_path):
+                tmp_path = f"{variant_path}.{uuid4().hex}.part"
+                resized = original.copy()
+                resized.thumbnail((size, size))
+                resized.save(tmp_path, format="WEBP", quality=80, method=4)
+                os.replace(tmp_path, variant_path)
+            rendered_variants.add(f"/uploads/{os.path.basename(variant_path)}")
+
+# Function to log a failed variant rendering, the original image stays usable
+def log_variant_failure(future):
+    if future.exception():
+        logger.error(f"Image variant generation failed: {str(future.exception())}")
+
+# Function to register the stored variants and queue the missing ones, for uploads that predate them or whose rendering failed
+def backfill_variants():
+    names = set(os.listdir(UPLOAD_DIR))
+    rendered_variants.update(f"/uploads/{name}" for name in names if name.endswith(".webp"))
+    for name in names:
+        stem, ext = os.path.splitext(name)
+        if ext not in IMAGE_SIGNATURES.values():
+            continue
+        if not all(f"{stem}_{variant}.webp" in names for variant in IMAGE_VARIANTS):
+            image_executor.submit(generate_variants, os.path.join(UPLOAD_DIR, name)).add_done_callback(log_variant_failure)
+
+# Function to save an image file, streamed in chunks with every disk write off the event loop
+async def save_image(image: UploadFile) -> str:
+    tmp_path = os.path.join(UPLOAD_DIR, f".{uuid4().hex}.part")
+    buffer = await run_in_threadpool(open, tmp_path, "wb")
+    try:
+        ext, size, digest = None, 0, hashlib.sha256()
+        while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+            if ext is None:
+                ext = sniff_image_type(chunk)
+                if ext is None:
+                    raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Invalid image format. Only JPEG and PNG images are allowed.")
+            size += len(chunk)
+            if size > MAX_IMAGE_SIZE:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"Image exceeds the {MAX_IMAGE_SIZE} bytes limit.")
+            digest.update(chunk)
+            await run_in_threadpool(buffer.write, chunk)
+        if ext is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty image file.")
+        # Images are stored under their content hash, so re-uploads of the same file collapse to one
+        filename = f"{digest.hexdigest()}{ext}"
+        file_path = os.path.join(UPLOAD_DIR, filename)
+        await run_in_threadpool(commit_upload, buffer, tmp_path, file_path)
+        image_executor.submit(generate_variants, file_path).add_done_callback(log_variant_failure)
+        return f"/uploads/{filename}"
+    except BaseException:
+        await run_in_threadpool(buffer.close)
+        await run_in_threadpool(discard_upload, tmp_path)
+        raise
+
+# Function to encode an opaque pagination cursor from the last row of a page
+def encode_cursor(order_by: str, sort_value, last_id) -> str:
+    payload = json.dumps([order_by, sort_value, last_id], default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+# Function to decode a pagination cursor, it must have been issued for the same ordering
+def decode_cursor(cursor: str, order_by: str) -> tuple:
+    try:
+        cursor_order_by, sort_value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if cursor_order_by != order_by:
+        raise ValueError("Cursor does not match the requested ordering")
+    return sort_value, last_id
+
+# Bulk import settings
+IMPORT_BATCH_SIZE = 500  # Rows inserted per round trip, overridable per request
+IMPORT_MAX_ERRORS = 1000  # Row errors listed in the import report, the failed count keeps counting past it
+IMPORT_MAX_RECORD_SIZE = 64 * 1024  # Characters an NDJSON line or a CSV record may span, a longer one is rejected rather than buffered
+IMPORT_FORMATS = {"application/x-ndjson": "ndjson", "application/jsonl": "ndjson", "text/csv": "csv"}
+
+# Function to map the content type of an import body to its format
+def import_format(content_type: Optional[str]) -> Optional[str]:
+    return IMPORT_FORMATS.get((content_type or "").split(";")[0].strip().lower())
+
+# Function to parse a streamed NDJSON or CSV body row by row, yields (row number, fields) or (row number, parse error)
+async def iter_import_rows(chunks: AsyncIterator[bytes], fmt: str) -> AsyncIterator[tuple[int, Union[dict, str]]]:
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    header, pending, row = None, [], 0
+    buffer, buffered, skipping = [], 0, False
+
+    def parse_ndjson(lines: List[str]):
+        nonlocal row
+        for line in lines:
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                fields = json.loads(line)
+            except ValueError as e:
+                yield row, f"Invalid JSON: {str(e)}"
+                continue
+            if not isinstance(fields, dict):
+                yield row, "Expected a JSON object"
+                continue
+            yield row, fields
+
+    def parse_csv(lines: List[str], final: bool = False):
+        nonlocal header, row
+        # Lines of a record still open at the end of the chunk are parsed again with the next one
+        pending.extend(line + "\n" for line in lines)
+        while pending:
+            reader = csv.reader(iter(pending), strict=True)
+            consumed, oversized = 0, False
+            while True:
+                try:
+                    fields = next(reader)
+                except StopIteration:
+                    break
+                except csv.Error as e:
+                    unterminated = reader.line_num == len(pending) and "unexpected end of data" in str(e)
+                    oversized = unterminated and sum(map(len, pending[consumed:])) > IMPORT_MAX_RECORD_SIZE
+                    if oversized or (unterminated and not final):
+                        break  # The quoted field goes on in the next chunk, unless it is already too long
+                    consumed = reader.line_num
+                    row += 1
+                    yield row, "Unterminated quoted field" if unterminated else f"Invalid CSV: {str(e)}"
+                    continue
+                consumed = reader.line_num
+                if not "".join(fields).strip():
+                    continue
+                if header is None:
+                    header = [name.strip() for name in fields]
+                    continue
+                row += 1
+                if len(fields) != len(header):
+                    yield row, f"Expected {len(header)} columns, got {len(fields)}"
+                    continue
+                # Empty cells are left out so the defaults apply
+                yield row, {name: value for name, value in zip(header, fields) if value != ""}
+            del pending[:consumed]
+            if not oversized:
+                break
+            # Rejected rather than buffered, parsing resumes after the line that opened the quoted field
+            del pending[0]
+            row += 1
+            yield row, f"Record longer than {IMPORT_MAX_RECORD_SIZE} characters"
+
+    def parse_lines(lines: List[str]):
+        # Complete lines longer than the limit are rejected without parsing them
+        parse = parse_csv if fmt == "csv" else parse_ndjson
+        start = 0
+        for index, line in enumerate(lines):
+            if len(line) > IMPORT_MAX_RECORD_SIZE:
+                yield from parse(lines[start:index])
+                start = index + 1
+                yield reject_long_line()
+        yield from parse(lines[start:])
+
+    def reject_long_line() -> tuple[int, str]:
+        nonlocal row
+        pending.clear()  # A CSV record open on that line is dropped with it
+        row += 1
+        return row, f"Line longer than {IMPORT_MAX_RECORD_SIZE} characters"
+
+    async for chunk in chunks:
+        *lines, tail = decoder.decode(chunk).split("\n")
+        if lines:
+            if skipping:
+                lines.pop(0)  # End of the line that was too long, resume after it
+                skipping = False
+            else:
+                lines[0] = "".join(buffer) + lines[0]
+            buffer, buffered = [], 0
+            for parsed in parse_lines(lines):
+                yield parsed
+        if skipping:
+            continue
+        # Incomplete last line, completed by the next chunks unless it grows too long
+        buffer.append(tail)
+        buffered += len(tail)
+        if buffered > IMPORT_MAX_RECORD_SIZE:
+            buffer, buffered, skipping = [], 0, True
+            yield reject_long_line()
+    last_line = ["" if skipping else "".join(buffer) + decoder.decode(b"", final=True)]
+    for parsed in parse_csv(last_line, final=True) if fmt == "csv" else parse_ndjson(last_line):
+        yield parsed
+
+# Export settings
+EXPORT_BATCH_SIZE = 1000  # Rows fetched from the cursor and written per response chunk
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Function to encode partitions of rows as NDJSON or CSV, every partition becomes one chunk of the response
+async def encode_export(partitions: AsyncIterator[list], model: type[BaseModel], fmt: str,
+                        flatten: Callable[[dict], List[dict]] = lambda record: [record]) -> AsyncIterator[bytes]:
+    header = None
+    async for partition in partitions:
+        records = [model.model_validate(row) for row in partition]
+        if fmt == "ndjson":
+            yield b"".join(record.model_dump_json().encode() + b"\n" for record in records)
+            continue
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for record in records:
+            for line in flatten(record.model_dump(mode="json")):
+                if header is None:
+                    header = list(line)
+                    writer.writerow(header)
+                writer.writerow([line.get(name) for name in header])
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+
+# Function to flatten an order into one CSV line per item, an order without items keeps one line with empty item columns
+def flatten_order(order: dict) -> List[dict]:
+    fields = {name: value for name, value in order.items() if not isinstance(value, list)}
+    items = next((value for value in order.values() if isinstance(value, list)), [])
+    if not items:
+        return [{**fields, "product_id": None, "product_name": None, "unit_price": None, "quantity": None}]
+    return [{**fields, "product_id": item["product"]["id"], "product_name": item["product"]["name"],
+             "unit_price": item["product"]["price"], "quantity": item["quantity"]} for item in items]
@@ -1,12 +1,55 @@
 from sqlmodel import Field, Session, String, SQLModel, create_engine, Relationship, select, Column, func, DateTime
 from pydantic import EmailStr
 from datetime import datetime
-from typing import Optional, Literal
+from typing import Optional, Literal, Union, Callable, TypeVar, AsyncIterator
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from fastapi.concurrency import run_in_threadpool
+import os
+import re
+from cache import invalidate_products, invalidate_user
+from sqlalchemy import update, Index, text, table, column, event, inspect
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import QueuePool
 
 sqlite_file_name = "ecommerce.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
-engine = create_engine(sqlite_url, connect_args={"check_same_thread": False})
+# Serve the routes from an aiosqlite engine on the event loop instead of the threadpool
+DB_ASYNC = os.getenv("DB_ASYNC", "false").lower() in ("1", "true", "yes")
+
+# Performance profile applied to every SQLite connection
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # Readers don't block the writer and the writer doesn't block readers
+    "synchronous": "NORMAL",  # fsync at checkpoints instead of every commit, durable enough with WAL
+    "busy_timeout": 5000,  # Wait up to 5s for the write lock instead of failing with "database is locked"
+    "cache_size": -64000,  # 64 MB page cache per connection
+    "mmap_size": 268435456,  # 256 MB of memory mapped I/O
+    "temp_store": "MEMORY",
+}
+SQLITE_MAINTENANCE_INTERVAL = 600  # Seconds between WAL checkpoints and planner statistics refreshes
+
+# WAL allows concurrent readers, so keep enough pooled connections for the request threadpool
+engine = create_engine(sqlite_url, connect_args={"check_same_thread": False}, poolclass=QueuePool, pool_size=10, max_overflow=20)
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{sqlite_file_name}", pool_size=10, max_overflow=20) if DB_ASYNC else None
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+event.listen(engine, "connect", apply_sqlite_pragmas)
+if async_engine is not None:
+    event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+
+def optimize_sqlite():
+    """Checkpoint the WAL back into the database file and refresh the query planner statistics."""
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.exec_driver_sql("PRAGMA optimize")
+
+T = TypeVar("T")
 
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -18,7 +61,18 @@ class User(SQLModel, table=True):
 
     orders: list["Order"] = Relationship(back_populates="user")
 
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_cached_user(mapper, connection, target: User):
+    """Drop the cached principal whenever a user record changes, including under its previous email."""
+    previous_emails = inspect(target).attrs.email.history.deleted or ()
+    invalidate_user(target.email, *previous_emails)
+
 class Product(SQLModel, table=True):
+    # Composite indexes backing the (sort key, id) keyset pagination of the catalog
+    __table_args__ = (Index("ix_product_name_id", "name", "id"), Index("ix_product_created_at_id", "created_at", "id"))
+
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str = Field(max_length=100, index=True)
     price: float
@@ -29,12 +83,23 @@ class Product(SQLModel, table=True):
     updated_at: Optional[datetime] = Field(sa_column=Column(DateTime(timezone=True), default=func.now(), onupdate=func.now()))
     order_items: list["OrderItem"] = Relationship(back_populates="product", cascade_delete=True)
 
+    @classmethod
+    def bulk_insert(cls, rows: list[dict], db: Session):
+        """Insert a batch of products with one commit, the unit of work sends them as a single executemany."""
+        try:
+            db.add_all([cls(**row) for row in rows])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
     def update_stock(self, quantity: int, db: Session):
         if self.stock >= quantity:
             self.stock -= quantity
             db.add(self)  # Add the updated product to the session
             db.commit()  # Commit the changes to the database
             db.refresh(self)  # Refresh the instance to get the updated data
+            invalidate_products(self.id)  # Drop the cached catalog responses showing the old stock
         else:
             raise ValueError("Not enough stock available")
     
@@ -62,6 +127,11 @@ class Order(SQLModel, table=True):
     def total_price(self) -> float:
         return sum(item.product.price * item.quantity for item in self.items if item.product)
 
+    @classmethod
+    def select_with_items(cls):
+        """Select orders with their items and products eager loaded, three queries whatever the number of orders."""
+        return select(cls).options(selectinload(cls.items).selectinload(OrderItem.product))
+
     def update_status(self, new_status: str, db: Session):
         if new_status in ["Pending", "Paid", "Shipped", "Delivered"]:
             self.status = new_status
@@ -72,19 +142,135 @@ class Order(SQLModel, table=True):
             raise ValueError("Invalid status value")
     
     def update_stock(self, db: Session):
+        """Reserve stock for every item in a single transaction. The caller commits or rolls back."""
+        # Merge repeated lines so each product is decremented once
+        quantities: dict[int, int] = {}
+        for item in self.items:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+
+        # Load every product in the order with one IN query
+        products = {product.id: product for product in db.exec(select(Product).where(Product.id.in_(quantities))).all()}
+        if len(products) != len(quantities):
+            raise ValueError("Product not found in order items")
+
+        # Guarded decrement: the row only changes if enough stock is left at write time
+        for product_id, quantity in quantities.items():
+            result = db.execute(
+                update(Product)
+                .where(Product.id == product_id, Product.stock >= quantity)
+                .values(stock=Product.stock - quantity)
+            )
+            if result.rowcount != 1:
+                raise ValueError(f"Not enough stock available for product: {products[product_id].name}")
+
+        # Attach the loaded products so the response doesn't lazy load them again
         for item in self.items:
-            product = db.exec(select(Product).where(Product.id == item.product_id)).first()
-            if product:
-                product.update_stock(item.quantity, db)
-            else:
-                raise ValueError("Product not found in order items")
+            item.product = products[item.product_id]
+
+    def place(self, db: Session) -> "Order":
+        """Reserve stock and insert the order in one transaction, then reload it with its items and products."""
+        try:
+            self.update_stock(db)  # Raises if any line lacks stock, nothing is committed yet
+            db.add(self)
+            db.commit()
+        except Exception:
+            # Undo any stock already decremented for this order
+            db.rollback()
+            raise
+        return db.exec(Order.select_with_items().where(Order.id == self.id).execution_options(populate_existing=True)).one()
     
 
 
+# Full-text index over product name and description, an external content FTS5 table kept in sync by triggers
+product_fts = table("product_fts", column("rowid"), column("rank"))
+
+PRODUCT_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5(name, description, content='product', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    # Only name and description are indexed, so stock updates don't touch the index
+    """CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE OF name, description ON product BEGIN
+        INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END""",
+]
+
+def create_search_index():
+    with engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'product_fts'")).first()
+        for ddl in PRODUCT_FTS_DDL:
+            conn.execute(text(ddl))
+        if not exists:
+            # Rank name matches above description matches and index the products that already exist
+            conn.execute(text("INSERT INTO product_fts(product_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')"))
+            conn.execute(text("INSERT INTO product_fts(product_fts) VALUES ('rebuild')"))
+
+def match_products(statement, query: str):
+    """Restrict a Product select to full-text matches on name and description, best matches first."""
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return statement
+    # Quote every term and match it as a prefix so a partially typed word still matches
+    match = " ".join(f'"{term}"*' for term in terms)
+    return (statement.join(product_fts, product_fts.c.rowid == Product.id)
+            .where(text("product_fts MATCH :match").bindparams(match=match))
+            .order_by(product_fts.c.rank))
+
 def create_tables():
     SQLModel.metadata.create_all(engine)
+    create_search_index()
     SQLModel.model_rebuild() # Rebuild the model to ensure all relationships are set up correctly
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+async def get_async_session():
+    # Keep attributes loaded after commit, they can't be lazy loaded outside the event loop's greenlet
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+# Session dependency used by the routes, selected by DB_ASYNC
+get_db = get_async_session if DB_ASYNC else get_session
+DBSession = Union[Session, AsyncSession]
+
+async def stream_partitions(statement, batch_size: int) -> AsyncIterator[list]:
+    """Yield the rows of a query in partitions read from a server-side cursor (yield_per).
+
+    Streaming responses outlive the request scoped session, so the stream opens a session of its own.
+    """
+    statement = statement.execution_options(yield_per=batch_size)
+    if DB_ASYNC:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            result = await session.stream_scalars(statement)
+            async for partition in result.partitions():
+                yield partition
+        return
+    with Session(engine) as session:
+        result = await run_in_threadpool(session.exec, statement)
+        partitions = result.partitions()
+        while partition := await run_in_threadpool(next, partitions, None):
+            yield partition
+
+async def run_db(db: DBSession, fn: Callable[[Session], T]) -> T:
+    """Run fn with a sync Session: on the event loop through AsyncSession.run_sync in async mode, in the threadpool otherwise."""
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn)
+    return await run_in_threadpool(fn, db)
+
+async def exec_all(db: DBSession, statement) -> list:
+    return await run_db(db, lambda session: session.exec(statement).all())
+
+async def exec_first(db: DBSession, statement):
+    return await run_db(db, lambda session: session.exec(statement).first())
+
+def save(db: Session, instance: T) -> T:
+    """Insert or update a single instance and reload it."""
+    db.add(instance)
+    db.commit()
+    db.refresh(instance)
+    return instance
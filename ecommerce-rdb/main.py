@@ -1,28 +1,55 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from database import create_tables
+from database import create_tables, async_engine, optimize_sqlite, SQLITE_MAINTENANCE_INTERVAL
+from fastapi.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
-from routes.auth import router as auth_router
+from routes.auth import router as auth_router, admin_depends
 from routes.store import router as store_router
-from routes.chat import router as chat_router
+from routes.chat import router as chat_router, chat_stats
 from logger_config import logger
+from cache import catalog_cache, answer_cache, semantic_answer_cache
+from compression import CompressionMiddleware, RESPONSE_COMPRESSION, compression_stats
+from upload_limit import UploadLimitMiddleware, FORM_OVERHEAD
+from static_files import UploadFiles
+from utils import backfill_variants, MAX_IMAGE_SIZE
+import asyncio
 import os
 import uvicorn
 
 
+async def sqlite_maintenance():
+    """Periodically checkpoint the WAL and refresh planner statistics off the event loop."""
+    while True:
+        await asyncio.sleep(SQLITE_MAINTENANCE_INTERVAL)
+        try:
+            await run_in_threadpool(optimize_sqlite)
+        except Exception as e:
+            logger.error(f"SQLite maintenance failed: {str(e)}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_tables()
+    backfill_variants()  # Queued on the image executor, startup doesn't wait for the rendering
+    maintenance = asyncio.create_task(sqlite_maintenance())
     yield
+    maintenance.cancel()
+    if async_engine is not None:
+        await async_engine.dispose()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)  # orjson for routes returning plain data
 
-# Static files directory for image uploads
+# Static files directory for image uploads, served with immutable caching
 UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+app.mount("/uploads", UploadFiles(directory=UPLOAD_DIR), name="uploads")
+
+# Refuse oversized image uploads before the multipart body is spooled
+app.add_middleware(UploadLimitMiddleware, max_body_size=MAX_IMAGE_SIZE + FORM_OVERHEAD)
+
+# Compress responses, streamed chunks are flushed one by one
+if RESPONSE_COMPRESSION:
+    app.add_middleware(CompressionMiddleware)
 
 # Enable CORS
 app.add_middleware(
@@ -31,6 +58,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],  # Let browsers read the pagination cursor and validators
 )
 
 # Custom exception handler for HTTPException
@@ -47,6 +75,14 @@ app.include_router(auth_router)
 app.include_router(store_router)
 app.include_router(chat_router)
 
+# Internal runtime stats, admins only and hidden from the public API docs
+@app.get("/internal/stats", include_in_schema=False)
+def internal_stats(current_user: admin_depends):
+    return {"catalog_cache": catalog_cache.stats(),
+            "compression": compression_stats,
+            "answer_cache": {"exact": answer_cache.stats(), "semantic": semantic_answer_cache.stats()},
+            "chat": chat_stats()}
+
 
 if __name__ == "__main__":
     uvicorn.run("main:app", log_level="info", reload=True)
\ No newline at end of file
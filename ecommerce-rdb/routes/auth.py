@@ -1,18 +1,23 @@
-from utils import create_access_token, verify_password, hash_password, decode_access_token
+from utils import create_access_token, verify_password, hash_password, decode_access_token, run_password_task
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi import Depends, HTTPException, APIRouter, status
-from sqlmodel import Session, select
-from database import User, get_session
+from sqlmodel import select
+from database import User, get_db, DBSession, run_db, exec_first, save
 from schemas import Token, UserOut
+from cache import user_cache
 import jwt
+import os
 from typing import Annotated
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
+# Emails allowed to use the admin routes, comma separated
+ADMIN_EMAILS = [email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()]
+
 # User authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_session)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: DBSession = Depends(get_db)):
     try:
         # Decode the token to extract user information
         payload = decode_access_token(token)
@@ -22,13 +27,25 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         if username is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
         
+        # Serve the principal from the cache for repeat callers
+        user = user_cache.get(username)
+        if user is not None:
+            return user
+
         # Fetch the user from the database
-        user = db.exec(select(User).where(User.email == username)).first()
-        if user is None:
+        version = user_cache.version
+        user_db = await exec_first(db, select(User).where(User.email == username))
+        if user_db is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
-        
+
+        # Cache a detached copy so it outlives this request's session
+        user = UserOut.model_validate(user_db, from_attributes=True)
+        user_cache.set(username, user, version)
         return user
 
+    except HTTPException:
+        raise
+
     except jwt.PyJWTError as e:
         # Catch JWT decoding errors and provide a custom message
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
@@ -39,49 +56,63 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
 
 user_depends = Annotated[UserOut, Depends(get_current_user)]
 
+async def get_current_admin(current_user: user_depends) -> UserOut:
+    # Admin routes are limited to the configured emails
+    if current_user.email.lower() not in {email.lower() for email in ADMIN_EMAILS}:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
+admin_depends = Annotated[UserOut, Depends(get_current_admin)]
+
 @router.post("/token", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_session)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: DBSession = Depends(get_db)):
     try:
         # Fetch the user based on email (username)
-        user = db.exec(select(User).where(User.email == form_data.username)).first()
+        user = await exec_first(db, select(User).where(User.email == form_data.username))
         
         # Handle invalid credentials
-        if not user or not verify_password(form_data.password, user.password_hash):
+        if not user or not await run_password_task(verify_password, form_data.password, user.password_hash):
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Incorrect username or password")
         
         # Generate access token
         access_token = create_access_token(data={"sub": user.email})
         return access_token
     
+    except HTTPException:
+        # Keep 400s and the 503 raised when the password executor is saturated
+        raise
+
     except Exception as e:
         # Catch any unexpected errors (e.g., database failure)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred during login")
 
 @router.post("/register", response_model=UserOut)
-def register(username: str, email: str, password: str, db: Session = Depends(get_session)):
+async def register(username: str, email: str, password: str, db: DBSession = Depends(get_db)):
     try:
         # Check if the email already exists in the database
-        existing_user = db.exec(select(User).where(User.email == email)).first()
+        existing_user = await exec_first(db, select(User).where(User.email == email))
         if existing_user:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
         
         # Hash the password
-        hashed_password = hash_password(password)
+        hashed_password = await run_password_task(hash_password, password)
         
         # Create and insert the new user
         user = User(username=username, email=email, password_hash=hashed_password)
-        db.add(user)
-        db.commit()
-        db.refresh(user)  # Refresh the instance to get the updated data
+        user = await run_db(db, lambda session: save(session, user))
         
         return user
 
+    except HTTPException:
+        # Keep 400s and the 503 raised when the password executor is saturated
+        raise
+
     except Exception as e:
         # Handle unexpected errors (e.g., database failure)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred during registration")
 
 @router.get("/me", response_model=UserOut)
-def read_users_me(current_user: user_depends):
+async def read_users_me(current_user: user_depends):
     try:
         return current_user
     except Exception as e:
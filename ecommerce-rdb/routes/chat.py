@@ -1,21 +1,112 @@
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Annotated, List, Tuple
+from operator import itemgetter
 from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
 from langchain_community.document_loaders import CSVLoader
 from langchain_community.vectorstores import FAISS
 from langchain_community.docstore.in_memory import InMemoryDocstore
-from langchain_core.runnables import RunnablePassthrough, RunnableSerializable
+from langchain_core.runnables import RunnableSerializable
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.documents import Document
 from langchain import hub
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Query, Request
 from fastapi.responses import StreamingResponse
-from schemas import ChatRequest
+from schemas import ChatRequest, FAQMatch
 from logger_config import logger
+from cache import answer_cache, semantic_answer_cache, invalidate_answers
 import faiss
 import os
 import asyncio
+import re
+import time
+from collections import deque
 
 FAISS_PATH = "faiss_vector_store"
 FAQ_PATH = "data/faq.csv"
+FAQ_MATCH_THRESHOLD = float(os.getenv("FAQ_MATCH_THRESHOLD", "0.9"))  # Similarity from which the stored answer is returned without the LLM
+SSE_FRAME_INTERVAL = float(os.getenv("SSE_FRAME_INTERVAL", "0.05"))  # Seconds a token may wait in the buffer before its frame is sent
+SSE_FRAME_SIZE = int(os.getenv("SSE_FRAME_SIZE", "256"))  # Buffered characters that send a frame right away
+FIRST_TOKEN_SAMPLES = 1000  # Latest answers kept per source for the time to first token percentiles
+
+# Time to first token per answer source and answers cut short by the client, exposed by /internal/stats
+first_token_ms = {source: deque(maxlen=FIRST_TOKEN_SAMPLES) for source in ("cache", "faq", "llm")}
+stream_stats = {"disconnected": 0}
+
+def normalize_prompt(prompt: str) -> str:
+    """Lowercase a prompt and drop punctuation and repeated whitespace, the key of the exact answer cache."""
+    return " ".join(re.sub(r"[^\w\s]", " ", prompt.lower()).split())
+
+def faq_entry(doc: Document) -> dict:
+    """Split a FAQ document loaded from faq.csv back into its question and answer."""
+    answer = re.search(r"^Answer: (.*)", doc.page_content, re.MULTILINE | re.DOTALL)
+    return {"question": doc.metadata["source"], "answer": answer.group(1).strip() if answer else doc.page_content}
+
+def record_first_token(source: str, started: float):
+    """Record the time from the chat request to its first token."""
+    first_token_ms[source].append((time.perf_counter() - started) * 1000)
+
+def chat_stats() -> dict:
+    """Time to first token percentiles per answer source, and the streams closed by the client."""
+    first_token = {}
+    for source, samples in first_token_ms.items():
+        ordered = sorted(samples)
+        first_token[source] = {
+            "answers": len(ordered),
+            "p50_ms": round(ordered[len(ordered) // 2], 1) if ordered else None,
+            "p95_ms": round(ordered[int(len(ordered) * 0.95)], 1) if ordered else None,
+        }
+    return {"first_token": first_token, **stream_stats}
+
+def sse_frame(text: str) -> str:
+    """Encode text as one Server-Sent Event, a data line per line of text."""
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
+async def wait_for_disconnect(request: Request):
+    """Return once the client has closed the connection."""
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+async def sse_events(answer: AsyncGenerator[str, None], request: Request) -> AsyncGenerator[str, None]:
+    """Stream an answer as Server-Sent Events, with its tokens coalesced into frames.
+
+    The first token is sent right away, the next ones once SSE_FRAME_SIZE characters are buffered
+    or SSE_FRAME_INTERVAL seconds after the oldest buffered token. The answer is cancelled as soon
+    as the client disconnects, so no more tokens are generated for nobody.
+    """
+    loop = asyncio.get_running_loop()
+    disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+    next_chunk = None
+    buffer, buffered, deadline, first = [], 0, None, True
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(answer.__anext__())
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_chunk, disconnected}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if disconnected in done:
+                stream_stats["disconnected"] += 1
+                logger.info("Client disconnected, FAQ answer cancelled")
+                return
+            if next_chunk in done:
+                chunk, next_chunk = next_chunk, None
+                try:
+                    buffer.append(chunk.result())
+                except StopAsyncIteration:
+                    break
+                buffered += len(buffer[-1])
+                if not first and buffered < SSE_FRAME_SIZE:
+                    deadline = deadline or loop.time() + SSE_FRAME_INTERVAL
+                    continue
+            yield sse_frame("".join(buffer))
+            buffer, buffered, deadline, first = [], 0, None, False
+        if buffer:
+            yield sse_frame("".join(buffer))
+        yield "event: done\ndata: \n\n"
+    finally:
+        disconnected.cancel()
+        if next_chunk is not None:
+            next_chunk.cancel()  # Interrupts the LLM stream the answer is waiting on
+        else:
+            await answer.aclose()
 
 class RAGManager:
     def __init__(self):
@@ -49,24 +140,64 @@ class RAGManager:
         loader = CSVLoader(file_path=faq_path, source_column="Question")
         docs = loader.load()
         self.vector_store.add_documents(documents=docs)
+        invalidate_answers()  # Cached answers may quote the previous FAQ
         
     def get_chain(self) -> RunnableSerializable:
-        """Returns the chain for the RAG process."""
+        """Returns the chain for the RAG process, fed with the retrieved context and the question."""
         prompt = hub.pull("rlm/rag-prompt")
-        retriever = self.vector_store.as_retriever(search_kwargs={"k": 2})
         return (
-            {"context": retriever, "question": RunnablePassthrough()}
+            {"context": lambda inputs: "\n\n".join(doc.page_content for doc in inputs["docs"]), "question": itemgetter("question")}
             | prompt
             | self.llm
             | StrOutputParser()
         )
         
+    async def search(self, embedding: List[float], k: int = 2) -> List[Tuple[Document, float]]:
+        """Top-k FAQ documents for an embedded prompt with their cosine similarity.
+
+        The HNSW index returns squared L2 distances, for unit length embeddings cos = 1 - d² / 2.
+        """
+        results = await self.vector_store.asimilarity_search_with_score_by_vector(embedding, k=k)
+        return [(doc, 1 - float(distance) / 2) for doc, distance in results]
+
     async def chat(self, prompt: str) -> AsyncGenerator[str, None]:
-        """Handles the chat interaction."""
+        """Handles the chat interaction, answers to the same or a similar prompt are replayed from the cache."""
+        started = time.perf_counter()
         try:
-            async for chunk in self.chain.astream(prompt):
+            # Exact tier first, it costs no embedding call
+            key = normalize_prompt(prompt)
+            chunks = answer_cache.get(key)
+            embedding = None
+            if chunks is None:
+                # The prompt is embedded once, for the semantic tier and for retrieval
+                embedding = await self.embeddings.aembed_query(prompt)
+                chunks = semantic_answer_cache.get_similar(embedding)
+                if chunks is not None:
+                    answer_cache.set(key, chunks)  # The next identical prompt skips the embedding call
+            if chunks is not None:
+                record_first_token("cache", started)
+                for chunk in chunks:
+                    yield chunk
+                return
+
+            versions = answer_cache.version, semantic_answer_cache.version
+            results = await self.search(embedding, k=2)
+            if results and results[0][1] >= FAQ_MATCH_THRESHOLD:
+                # The question is in the FAQ, its stored answer needs no generation
+                record_first_token("faq", started)
+                yield faq_entry(results[0][0])["answer"]
+                return
+
+            chunks = []
+            async for chunk in self.chain.astream({"docs": [doc for doc, _ in results], "question": prompt}):
+                if not chunks:
+                    record_first_token("llm", started)
+                chunks.append(chunk)
                 yield chunk
-                await asyncio.sleep(0.1)  ## Simulate a delay for streaming effect
+
+            # Only complete answers are cached, in the chunks they were streamed in
+            answer_cache.set(key, tuple(chunks), versions[0])
+            semantic_answer_cache.set_similar(key, embedding, tuple(chunks), versions[1])
         except Exception as e:
             logger.error(f"Error during chat: {e}")
             yield "Sorry, I couldn't process your request at the moment."
@@ -76,6 +207,22 @@ faq_manager = RAGManager()
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
+# Route to stream a FAQ answer, as Server-Sent Events when the client accepts text/event-stream
 @router.post("/faq")
-async def chat_stream(request: ChatRequest):
-    return StreamingResponse(faq_manager.chat(request.prompt), media_type="text/plain")
+async def chat_stream(chat_request: ChatRequest, request: Request):
+    answer = faq_manager.chat(chat_request.prompt)
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(sse_events(answer, request), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    return StreamingResponse(answer, media_type="text/plain")
+
+# Route to look up the FAQ entries closest to a query, without the LLM
+@router.get("/faq/search", response_model=List[FAQMatch])
+async def search_faq(query: Annotated[str, Query(min_length=1, max_length=500)],
+                     k: Annotated[int, Query(gt=0, le=20)] = 3):
+    try:
+        embedding = await faq_manager.embeddings.aembed_query(query)
+        results = await faq_manager.search(embedding, k=k)
+        return [FAQMatch(**faq_entry(doc), score=round(score, 4)) for doc, score in results]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching the FAQ: {str(e)}")
@@ -1,91 +1,230 @@
-from fastapi import APIRouter, HTTPException, Path, Query, Depends, Form, UploadFile, File
-from schemas import ProductOut, OrderIn, OrderOut
-from database import Product, Order, OrderItem, get_session
-from routes.auth import user_depends
-from sqlmodel import Session, select, desc
+from fastapi import APIRouter, HTTPException, Path, Query, Depends, Form, UploadFile, File, Response, Request
+from schemas import ProductIn, ProductOut, OrderIn, OrderOut, OrderExport
+from database import Product, Order, OrderItem, get_db, DBSession, run_db, exec_all, exec_first, save, match_products, stream_partitions
+from routes.auth import user_depends, admin_depends
+from cache import catalog_cache, invalidate_products, CATALOG_CACHE_CONTROL
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter, ValidationError
+from sqlmodel import select, desc, or_, and_, func
+from sqlalchemy.exc import IntegrityError, DataError
 from typing import List, Annotated, Optional, Literal
-from utils import save_image
+from utils import save_image, encode_cursor, decode_cursor, import_format, iter_import_rows, IMPORT_BATCH_SIZE, IMPORT_MAX_ERRORS, encode_export, flatten_order, EXPORT_BATCH_SIZE, EXPORT_MEDIA_TYPES
+from datetime import datetime
+import hashlib
 
 router = APIRouter(prefix="/store", tags=["store"])
 
+product_list_adapter = TypeAdapter(List[ProductOut])
+order_list_adapter = TypeAdapter(List[OrderOut])
+
+def json_response(adapter: TypeAdapter, data) -> Response:
+    """Validate ORM objects in a single pass and dump them straight to JSON bytes, skipping response_model validation."""
+    return Response(content=adapter.dump_json(adapter.validate_python(data)), media_type="application/json")
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag."""
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def catalog_response(request: Request, route: str, body: bytes, next_cursor: Optional[str] = None) -> Response:
+    """Wrap an already serialized catalog body, skipping response_model validation.
+
+    The ETag is a hash of the body, so it changes exactly when the payload does and a
+    matching If-None-Match gets an empty 304.
+    """
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": CATALOG_CACHE_CONTROL[route]}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # Route to create a new product
 @router.post("/products/", response_model=ProductOut)
-def create_product(current_user: user_depends,
+async def create_product(current_user: user_depends,
                    name: Annotated[str, Form()],
                    price: Annotated[float, Form(gt=0)],
                    stock: Annotated[Optional[int], Form(ge=0)] = 10,
                    description: Annotated[Optional[str], Form()] = None,
                    image: Optional[UploadFile] = File(None),
-                   db: Session = Depends(get_session)):
+                   db: DBSession = Depends(get_db)):
     try:
         image_url = None
         if image:
-            image_url = save_image(image)  # Save the image to the server
+            image_url = await save_image(image)  # Stream the image to the server
         product_doc = Product(name=name, price=price, description=description, stock=stock, image_url=image_url)
-        db.add(product_doc)
-        db.commit()
-        db.refresh(product_doc)  # Refresh the instance to get the updated data
+        product_doc = await run_db(db, lambda session: save(session, product_doc))
+        invalidate_products(product_doc.id)  # Cached listings don't include the new product yet
         return product_doc
+    except HTTPException:
+        raise  # Rejected image
     except Exception as e:
         # Handle any unexpected errors during insert
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+# Route to import products in bulk from a streamed NDJSON or CSV body
+@router.post("/products/bulk")
+async def import_products(request: Request, current_user: user_depends,
+                   batch_size: Annotated[int, Query(gt=0, le=5000)] = IMPORT_BATCH_SIZE,
+                   db: DBSession = Depends(get_db)):
+    fmt = import_format(request.headers.get("content-type"))
+    if fmt is None:
+        raise HTTPException(status_code=415, detail="Send the products as application/x-ndjson or text/csv")
+    report = {"inserted": 0, "failed": 0, "errors": []}
+    batch = []
+
+    def reject(row: int, errors: List[str]):
+        report["failed"] += 1
+        if len(report["errors"]) < IMPORT_MAX_ERRORS:
+            report["errors"].append({"row": row, "errors": errors})
+
+    async def insert(rows: list):
+        try:
+            await run_db(db, lambda session: Product.bulk_insert([values for _, values in rows], session))
+            report["inserted"] += len(rows)
+        except (IntegrityError, DataError) as e:
+            if len(rows) == 1:
+                reject(rows[0][0], [f"Insert failed: {str(e)}"])
+                return
+            # The whole batch was rolled back, retry each half so only the failing rows are rejected
+            middle = len(rows) // 2
+            await insert(rows[:middle])
+            await insert(rows[middle:])
+        except Exception as e:
+            # Not caused by the rows (database locked or down, pool timeout): retrying them one by one can't help
+            raise HTTPException(status_code=503, detail=f"Import aborted after {report['inserted']} products: {str(e)}")
+
+    async def flush():
+        await insert(batch[:])
+        batch.clear()
+
+    try:
+        # Rows are parsed as the body arrives, at most one batch is held in memory
+        async for row, fields in iter_import_rows(request.stream(), fmt):
+            if isinstance(fields, str):
+                reject(row, [fields])
+                continue
+            try:
+                product = ProductIn.model_validate(fields)
+            except ValidationError as e:
+                reject(row, [f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()])
+                continue
+            batch.append((row, product.model_dump(exclude_none=True)))
+            if len(batch) >= batch_size:
+                await flush()
+        if batch:
+            await flush()
+    finally:
+        if report["inserted"]:
+            invalidate_products()  # Cached listings don't include the imported products yet
+    return report
+
 # Route to get all products in the catalog
 @router.get("/products/", response_model=List[ProductOut])
-def get_products(offset: Annotated[int, Query(ge=0)] = 0,
+async def get_products(request: Request,
+                offset: Annotated[int, Query(ge=0)] = 0,
                 limit: Annotated[int, Query(gt=0)] = 10,
                 order_by: Literal["name", "-name", "created_at", "-created_at"] = "name",
-                db: Session = Depends(get_session)):
-    # Define the mapping for order_by parameter
-    order_map = {
-        "name": Product.name,
-        "-name": desc(Product.name),
-        "created_at": Product.created_at,
-        "-created_at": desc(Product.created_at)
-    }
+                cursor: Annotated[Optional[str], Query(description="Cursor from the X-Next-Cursor header of the previous page, takes precedence over offset")] = None,
+                db: DBSession = Depends(get_db)):
+    # Serve the already serialized page when it is cached
+    key = ("products", order_by, limit, cursor or offset)
+    cached = catalog_cache.get(key)
+    if cached is not None:
+        return catalog_response(request, "products", *cached)
+    version = catalog_cache.version
+
+    # Define the mapping for order_by parameter, the id breaks ties so the ordering is total
+    sort_field = order_by.lstrip("-")
+    descending = order_by.startswith("-")
+    column = {"name": Product.name, "created_at": Product.created_at}[sort_field]
+    ordering = (desc(column), desc(Product.id)) if descending else (column, Product.id)
+
+    statement = select(Product).where(Product.stock > 0)
+    if cursor:
+        try:
+            sort_value, last_id = decode_cursor(cursor, order_by)
+            if sort_field == "created_at":
+                sort_value = datetime.fromisoformat(sort_value)
+            # Cursors are client supplied, a mistyped value would be compared to the column as is
+            if sort_field == "name" and not isinstance(sort_value, str):
+                raise ValueError("Invalid cursor")
+            if not isinstance(last_id, int) or isinstance(last_id, bool):
+                raise ValueError("Invalid cursor")
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if sort_field == "created_at":
+            # SQLite stores CURRENT_TIMESTAMP without microseconds, normalise the bound value the same way
+            sort_value = func.datetime(sort_value)
+        # Seek past the last row of the previous page instead of skipping rows
+        if descending:
+            statement = statement.where(or_(column < sort_value, and_(column == sort_value, Product.id < last_id)))
+        else:
+            statement = statement.where(or_(column > sort_value, and_(column == sort_value, Product.id > last_id)))
+    else:
+        statement = statement.offset(offset)
     try:
-        products = db.exec(select(Product).where(Product.stock > 0).order_by(order_map.get(order_by)).offset(offset).limit(limit)).all()
-        return products
+        products = await exec_all(db, statement.order_by(*ordering).limit(limit))
+        next_cursor = None
+        if len(products) == limit:
+            last = products[-1]
+            next_cursor = encode_cursor(order_by, getattr(last, sort_field), last.id)
+        body = product_list_adapter.dump_json(product_list_adapter.validate_python(products))
+        catalog_cache.set(key, (body, next_cursor), version)
+        return catalog_response(request, "products", body, next_cursor)
     except Exception as e:
         # Handle any unexpected errors during query
         raise HTTPException(status_code=500, detail=f"Error fetching products: {str(e)}")
 
 # Route to get a specific product by ID
 @router.get("/products/{product_id}", response_model=ProductOut)
-def get_product(product_id: Annotated[str, Path(title="The ID of the product to retrieve")], db: Session = Depends(get_session)):
+async def get_product(request: Request, product_id: Annotated[int, Path(title="The ID of the product to retrieve")], db: DBSession = Depends(get_db)):
+    # Serve the already serialized product when it is cached, keyed by the parsed id as invalidate_products does
+    key = ("product", str(product_id))
+    body = catalog_cache.get(key)
+    if body is not None:
+        return catalog_response(request, "product", body)
+    version = catalog_cache.version
     try:
         # Try to fetch the product by ID
-        product = db.exec(select(Product).where(Product.id == product_id)).first()
+        product = await exec_first(db, select(Product).where(Product.id == product_id))
         if not product:
             raise HTTPException(status_code=404, detail="Product not found")
-        return product
+        body = ProductOut.model_validate(product).model_dump_json().encode()
+        catalog_cache.set(key, body, version)
+        return catalog_response(request, "product", body)
     except Exception as e:
         # Handle any unexpected errors during query
         raise HTTPException(status_code=500, detail=f"Error fetching product: {str(e)}")
 
 # Route to search for products
 @router.get("/search", response_model=List[ProductOut])
-def search_products(query: Annotated[Optional[str], Query(max_length=50)] = None,
+async def search_products(request: Request,
+                    query: Annotated[Optional[str], Query(max_length=50)] = None,
                     min_price: Annotated[Optional[float], Query(ge=0)] = None,
                     max_price: Annotated[Optional[float], Query(gt=0)] = None,
-                    db: Session = Depends(get_session)):
+                    db: DBSession = Depends(get_db)):
     try:
         statement = select(Product).where(Product.stock > 0)
         if query:
-            statement = statement.where(Product.name.ilike(f"%{query}%"))
+            # Full-text match on name and description, ranked by relevance
+            statement = match_products(statement, query)
         if min_price is not None:
             statement = statement.where(Product.price >= min_price)
         if max_price is not None:
             statement = statement.where(Product.price <= max_price)
-        products = db.exec(statement.order_by(Product.name)).all()
-        return products
+        products = await exec_all(db, statement.order_by(Product.name))  # Name breaks relevance ties
+        body = product_list_adapter.dump_json(product_list_adapter.validate_python(products))
+        return catalog_response(request, "search", body)
     except Exception as e:
         # Handle any unexpected errors during query
         raise HTTPException(status_code=500, detail=f"Error searching products: {str(e)}")
 
 # Route to create an order
 @router.post("/orders/", response_model=OrderOut)
-def create_order(order: OrderIn, current_user: user_depends, db: Session = Depends(get_session)):
+async def create_order(order: OrderIn, current_user: user_depends, db: DBSession = Depends(get_db)):
     try:
         # Step 1: Create a new Order object
         order_doc = Order(user_id=current_user.id)
@@ -95,22 +234,33 @@ def create_order(order: OrderIn, current_user: user_depends, db: Session = Depen
             order_item = OrderItem(product_id=item.product_id, quantity=item.quantity)
             order_doc.items.append(order_item)
 
-        # Step 3: Update the stock before inserting the order
-        order_doc.update_stock(db)  # This will reduce the stock based on the quantities
-        
-        # Step 4: Insert the order into the database
-        db.add(order_doc)
-        db.commit()
-        db.refresh(order_doc)  # Refresh the instance to get the updated data
+        # Step 3: Reserve the stock and insert the order in one transaction, rolled back if any line lacks stock
+        order_doc = await run_db(db, order_doc.place)
+        invalidate_products(*(item.product_id for item in order_doc.items))  # Stock changed for these products
         return order_doc
     except Exception as e:
         # Handle any unexpected errors during order creation
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 @router.get("/my-orders", response_model=List[OrderOut])
-def get_orders(current_user: user_depends, db: Session = Depends(get_session)):
+async def get_orders(current_user: user_depends, db: DBSession = Depends(get_db)):
     try:
-        orders = db.exec(select(Order).where(Order.user_id == current_user.id)).all()
-        return orders
+        # Items and products are eager loaded so serialization doesn't issue a query per item
+        orders = await exec_all(db, Order.select_with_items().where(Order.user_id == current_user.id))
+        return json_response(order_list_adapter, orders)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching orders: {str(e)}")
+
+# Route to export the whole catalog as NDJSON or CSV, streamed from a server-side cursor
+@router.get("/export/products")
+async def export_products(current_user: user_depends, format: Literal["ndjson", "csv"] = "ndjson"):
+    partitions = stream_partitions(select(Product).order_by(Product.id), EXPORT_BATCH_SIZE)
+    return StreamingResponse(encode_export(partitions, ProductOut, format), media_type=EXPORT_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="products.{format}"'})
+
+# Route to export every order as NDJSON or CSV (one line per item), streamed from a server-side cursor
+@router.get("/export/orders")
+async def export_orders(current_user: admin_depends, format: Literal["ndjson", "csv"] = "ndjson"):
+    partitions = stream_partitions(Order.select_with_items().order_by(Order.id), EXPORT_BATCH_SIZE)
+    return StreamingResponse(encode_export(partitions, OrderExport, format, flatten_order), media_type=EXPORT_MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="orders.{format}"'})
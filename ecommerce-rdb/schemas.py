@@ -1,7 +1,21 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, computed_field
 from typing import List, Optional, Literal
 from datetime import datetime
 
+# Responsive variants generated for every uploaded image, longest side in pixels
+IMAGE_VARIANTS = {"thumb": 200, "medium": 600}
+
+# Urls of the variants stored in uploads, filled by generate_variants and backfill_variants so serializing never touches the disk
+rendered_variants: set[str] = set()
+
+# Function to derive the url of an image variant, variants sit next to the original as <hash>_<variant>.webp
+def image_variant_url(image_url: Optional[str], variant: str) -> Optional[str]:
+    if not image_url:
+        return None
+    variant_url = f"{image_url.rsplit('.', 1)[0]}_{variant}.webp"
+    # Not rendered yet, failed, or uploaded before variants existed: link the original instead of a 404
+    return variant_url if variant_url in rendered_variants else image_url
+
 class Token(BaseModel):
     access_token: str = Field(..., description="JWT access token")
     token_type: str = Field(..., description="Type of the token, usually 'bearer'")
@@ -33,6 +47,16 @@ class ProductOut(BaseModel):
     created_at: Optional[datetime]
     updated_at: Optional[datetime]
 
+    @computed_field
+    @property
+    def thumbnail_url(self) -> Optional[str]:
+        return image_variant_url(self.image_url, "thumb")
+
+    @computed_field
+    @property
+    def medium_url(self) -> Optional[str]:
+        return image_variant_url(self.image_url, "medium")
+
     class Config:
         from_attributes = True  # Enable ORM mode to read data as dict
 
@@ -57,6 +81,7 @@ class OrderIn(BaseModel):
         from_attributes = True
 
 class OrderOut(BaseModel):
+    id: Optional[int] = None
     items: List[OrderItemOut]
     total_price: float
     status: Literal["Pending", "Paid", "Shipped", "Delivered"]
@@ -66,6 +91,14 @@ class OrderOut(BaseModel):
     class Config:
         from_attributes = True
 
+class OrderExport(OrderOut):
+    user_id: Optional[int]
+
 class ChatRequest(BaseModel):
     prompt: str
 
+class FAQMatch(BaseModel):
+    question: str
+    answer: str
+    score: float = Field(..., description="Cosine similarity between the query and the FAQ question, 1 is identical")
+
@@ -0,0 +1,47 @@
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+from mimetypes import guess_type
+import os
+import re
+import stat
+
+UPLOAD_CACHE_CONTROL = "public, max-age=31536000, immutable"  # Upload names never point to different content
+PRECOMPRESSED = {"br": ".br", "gzip": ".gz"}  # Encodings served from a sibling file, in order of preference
+CONTENT_ADDRESSED = re.compile(r"^(?P<digest>[0-9a-f]{64}(?:_\w+)?)\.\w+$")  # <sha256>[_<variant>].<ext>
+
+class UploadFiles(StaticFiles):
+    """Static files for uploads with long-lived caching, content based ETags and precompressed variants."""
+
+    def file_response(self, full_path: str, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        media_type = guess_type(full_path)[0] or "text/plain"
+        headers = {"Cache-Control": UPLOAD_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+
+        # Serve a precompressed sibling when the client accepts its encoding
+        encoding = None
+        accepted = {value.split(";")[0].strip() for value in request_headers.get("accept-encoding", "").split(",")}
+        for name, suffix in PRECOMPRESSED.items():
+            if name not in accepted:
+                continue
+            try:
+                compressed_stat = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            if stat.S_ISREG(compressed_stat.st_mode):
+                encoding, full_path, stat_result = name, full_path + suffix, compressed_stat
+                headers["Content-Encoding"] = name
+                break
+
+        # Content addressed names are their own strong validator, other files keep the mtime/size based ETag
+        match = CONTENT_ADDRESSED.match(os.path.basename(full_path.removesuffix(PRECOMPRESSED.get(encoding, ""))))
+        if match:
+            headers["ETag"] = f'"{match["digest"]}{"-" + encoding if encoding else ""}"'
+
+        # FileResponse answers Range requests itself
+        response = FileResponse(full_path, status_code=status_code, headers=headers, media_type=media_type, stat_result=stat_result)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,42 @@
+import os
+import sys
+
+# The app modules are imported as top level modules, the same way main.py imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from datetime import datetime, timezone
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.pool import StaticPool
+from sqlmodel import Session, SQLModel, create_engine
+from cache import catalog_cache
+from database import get_db
+from routes.auth import get_current_user
+from routes.store import router as store_router
+from schemas import UserOut
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    SQLModel.metadata.create_all(engine)
+    catalog_cache.invalidate()
+    yield engine
+    catalog_cache.invalidate()
+    engine.dispose()
+
+
+@pytest.fixture
+def client(engine):
+    """Store routes on the in-memory database, called by an authenticated user."""
+    def get_test_db():
+        with Session(engine) as session:
+            yield session
+
+    app = FastAPI()
+    app.include_router(store_router)
+    app.dependency_overrides[get_db] = get_test_db
+    app.dependency_overrides[get_current_user] = lambda: UserOut(
+        id=1, username="buyer", email="buyer@example.com", created_at=datetime.now(timezone.utc), updated_at=None)
+    return TestClient(app)
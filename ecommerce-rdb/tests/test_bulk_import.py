@@ -0,0 +1,43 @@
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, select
+from database import Product
+
+
+def import_csv(client, body: str, batch_size: int = 500):
+    return client.post(f"/store/products/bulk?batch_size={batch_size}", content=body.encode(),
+                       headers={"Content-Type": "text/csv"})
+
+
+def test_rows_failing_in_the_database_are_isolated(engine, client):
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TRIGGER reject_broken BEFORE INSERT ON product WHEN NEW.name LIKE 'broken%' "
+                          "BEGIN SELECT RAISE(ABORT, 'broken product'); END"))
+    names = [f"broken {i}" if i in (11, 78) else f"product {i}" for i in range(1, 101)]
+    body = "name,price\n" + "".join(f"{name},1.5\n" for name in names)
+
+    report = import_csv(client, body, batch_size=50).json()
+
+    assert report["inserted"] == 98
+    assert report["failed"] == 2
+    assert [error["row"] for error in report["errors"]] == [11, 78]
+    assert "broken product" in report["errors"][0]["errors"][0]
+    with Session(engine) as db:
+        assert len(db.exec(select(Product)).all()) == 98
+
+
+def test_database_outage_aborts_instead_of_retrying_every_row(client, monkeypatch):
+    calls = []
+
+    def bulk_insert(rows, db):
+        calls.append(len(rows))
+        raise OperationalError("INSERT", {}, Exception("database is locked"))
+
+    monkeypatch.setattr(Product, "bulk_insert", bulk_insert)
+    body = "name,price\n" + "".join(f"product {i},1.5\n" for i in range(100))
+
+    response = import_csv(client, body, batch_size=50)
+
+    assert response.status_code == 503
+    assert "database is locked" in response.json()["detail"]
+    assert calls == [50]
@@ -0,0 +1,38 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from sqlmodel import Session
+from cache import user_cache
+from database import User
+from routes.auth import get_current_user
+from utils import create_access_token
+
+
+@pytest.fixture
+def db(engine):
+    user_cache.invalidate()
+    with Session(engine) as session:
+        session.add(User(username="buyer", email="buyer@example.com", password_hash="x"))
+        session.commit()
+        yield session
+    user_cache.invalidate()
+
+
+def current_user(token: str, db: Session):
+    return asyncio.run(get_current_user(token, db))
+
+
+def test_known_subject_is_resolved(db):
+    user = current_user(create_access_token({"sub": "buyer@example.com"})["access_token"], db)
+    assert user.email == "buyer@example.com"
+
+
+@pytest.mark.parametrize("token", [
+    create_access_token({"sub": "nobody@example.com"})["access_token"],
+    create_access_token({"name": "no subject"})["access_token"],
+    "not a token",
+])
+def test_invalid_principal_is_unauthorized(db, token):
+    with pytest.raises(HTTPException) as error:
+        current_user(token, db)
+    assert error.value.status_code == 401
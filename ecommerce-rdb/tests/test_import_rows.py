@@ -0,0 +1,62 @@
+import asyncio
+import pytest
+import utils
+
+CHUNK_SIZES = [1, 3, 7, 4096]
+
+
+def parse(data: bytes, fmt: str, chunk_size: int) -> list:
+    async def chunks():
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+
+    async def collect():
+        return [row async for row in utils.iter_import_rows(chunks(), fmt)]
+
+    return asyncio.run(collect())
+
+
+@pytest.fixture(autouse=True)
+def small_records(monkeypatch):
+    monkeypatch.setattr(utils, "IMPORT_MAX_RECORD_SIZE", 40)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_csv_keeps_stray_quotes_and_quoted_newlines(chunk_size):
+    data = b'name,price\n12" pizza,5\n"multi\nline, name",4\nlast,1'
+    assert parse(data, "csv", chunk_size) == [
+        (1, {"name": '12" pizza', "price": "5"}),
+        (2, {"name": "multi\nline, name", "price": "4"}),
+        (3, {"name": "last", "price": "1"}),
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_csv_rejects_an_open_quoted_field_once_too_long(chunk_size):
+    data = b'name,price\n"never closed,1\n' + b"".join(b"p%d,%d\n" % (i, i) for i in range(8))
+    rows = parse(data, "csv", chunk_size)
+    assert rows[0] == (1, "Record longer than 40 characters")
+    assert [fields["name"] for _, fields in rows[1:]] == [f"p{i}" for i in range(8)]
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("fmt, header, line", [
+    ("csv", b"name,price\n", b"x" * 100 + b",1\n"),
+    ("ndjson", b"", b'{"name": "' + b"x" * 100 + b'"}\n'),
+])
+def test_long_line_is_rejected_and_skipped(chunk_size, fmt, header, line):
+    after = b"after,2\n" if fmt == "csv" else b'{"name": "after"}\n'
+    rows = parse(header + line + after, fmt, chunk_size)
+    assert rows[0] == (1, "Line longer than 40 characters")
+    assert rows[1][0] == 2 and rows[1][1]["name"] == "after"
+    assert len(rows) == 2
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_ndjson_reports_errors_per_row(chunk_size):
+    data = b'{"name": "a"}\n\nnot json\n[1]\n{"name": "b"}'
+    rows = parse(data, "ndjson", chunk_size)
+    assert rows[0] == (1, {"name": "a"})
+    assert rows[1][1].startswith("Invalid JSON")
+    assert rows[2] == (3, "Expected a JSON object")
+    assert rows[3] == (4, {"name": "b"})
@@ -0,0 +1,52 @@
+import pytest
+from sqlalchemy import event
+from sqlmodel import Session
+from database import User, Product, Order, OrderItem
+from schemas import OrderOut
+
+
+def seed_orders(engine, n_orders: int, n_items: int) -> int:
+    """Create a user with n_orders orders of n_items items each, every item for its own product."""
+    with Session(engine) as db:
+        user = User(username="buyer", email="buyer@example.com", password_hash="x")
+        db.add(user)
+        db.flush()
+        for o in range(n_orders):
+            order = Order(user_id=user.id)
+            for i in range(n_items):
+                product = Product(name=f"product {o}-{i}", price=1.5, stock=10)
+                order.items.append(OrderItem(product=product, quantity=i + 1))
+            db.add(order)
+        db.commit()
+        return user.id
+
+
+def count_order_history_statements(engine, user_id: int) -> tuple[int, list]:
+    """Load and serialize a user's orders as /store/my-orders does, counting the SQL statements issued."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        with Session(engine) as db:
+            orders = db.exec(Order.select_with_items().where(Order.user_id == user_id)).all()
+            payload = [OrderOut.model_validate(order).model_dump() for order in orders]
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements), payload
+
+
+# selectinload fetches up to 500 parent keys per IN query, the sizes stay under it
+@pytest.mark.parametrize("n_orders, n_items", [(1, 1), (5, 3), (20, 10), (40, 12)])
+def test_order_history_statement_count_is_constant(engine, n_orders, n_items):
+    user_id = seed_orders(engine, n_orders, n_items)
+
+    count, payload = count_order_history_statements(engine, user_id)
+
+    # Orders, their items and the items' products: one query each whatever the history size
+    assert count == 3
+    assert len(payload) == n_orders
+    assert all(len(order["items"]) == n_items for order in payload)
+    assert payload[0]["total_price"] == pytest.approx(1.5 * sum(range(1, n_items + 1)))
@@ -0,0 +1,22 @@
+from sqlmodel import Session
+from database import Product
+
+
+def test_product_cache_is_invalidated_whatever_the_id_spelling(engine, client):
+    with Session(engine) as db:
+        product = Product(name="Lamp", price=19.9, stock=5)
+        db.add(product)
+        db.commit()
+        db.refresh(product)
+
+        assert client.get("/store/products/01").json()["stock"] == 5
+        assert client.get("/store/products/1").json()["stock"] == 5
+
+        product.update_stock(2, db)  # Invalidates the cached product as an order does
+
+    assert client.get("/store/products/01").json()["stock"] == 3
+    assert client.get("/store/products/1").json()["stock"] == 3
+
+
+def test_product_id_must_be_an_integer(client):
+    assert client.get("/store/products/abc").status_code == 422
@@ -0,0 +1,34 @@
+import base64
+import json
+import pytest
+from sqlmodel import Session
+from database import Product
+from utils import encode_cursor
+
+
+def raw_cursor(payload: list) -> str:
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def test_cursor_pages_follow_each_other(engine, client):
+    with Session(engine) as db:
+        db.add_all([Product(name=f"product {i:02}", price=1.5) for i in range(5)])
+        db.commit()
+
+    first = client.get("/store/products/?limit=3")
+    second = client.get(f"/store/products/?limit=3&cursor={first.headers['X-Next-Cursor']}")
+
+    assert [p["name"] for p in first.json()] == ["product 00", "product 01", "product 02"]
+    assert [p["name"] for p in second.json()] == ["product 03", "product 04"]
+
+
+@pytest.mark.parametrize("cursor", [
+    raw_cursor(["name", "x", "abc"]),
+    raw_cursor(["name", "x", 1.5]),
+    raw_cursor(["name", 5, 1]),
+    raw_cursor(["created_at", "not a date", 1]),
+    encode_cursor("-name", "x", 1),
+    "not base64 json",
+])
+def test_malformed_cursor_is_rejected(client, cursor):
+    assert client.get(f"/store/products/?cursor={cursor}").status_code == 400
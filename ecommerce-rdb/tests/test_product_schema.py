@@ -0,0 +1,33 @@
+from datetime import datetime, timezone
+import pytest
+from schemas import ProductOut, rendered_variants
+
+
+def product_out(image_url) -> ProductOut:
+    return ProductOut(id=1, name="Lamp", price=19.9, stock=3, image_url=image_url,
+                      description=None, created_at=datetime.now(timezone.utc), updated_at=None)
+
+
+@pytest.fixture(autouse=True)
+def clear_rendered_variants():
+    rendered_variants.clear()
+    yield
+    rendered_variants.clear()
+
+
+def test_product_with_image_falls_back_to_the_original_without_variants():
+    data = product_out("/uploads/abc.jpg").model_dump(mode="json")
+    assert data["thumbnail_url"] == "/uploads/abc.jpg"
+    assert data["medium_url"] == "/uploads/abc.jpg"
+
+
+def test_product_with_image_links_rendered_variants():
+    rendered_variants.add("/uploads/abc_thumb.webp")
+    data = product_out("/uploads/abc.jpg").model_dump(mode="json")
+    assert data["thumbnail_url"] == "/uploads/abc_thumb.webp"
+    assert data["medium_url"] == "/uploads/abc.jpg"
+
+
+def test_product_without_image_has_no_variants():
+    data = product_out(None).model_dump(mode="json")
+    assert data["thumbnail_url"] is None and data["medium_url"] is None
@@ -0,0 +1,54 @@
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+from upload_limit import UploadLimitMiddleware
+
+LIMIT = 1024
+
+
+def upload_client(received: list) -> TestClient:
+    app = FastAPI()
+    app.add_middleware(UploadLimitMiddleware, max_body_size=LIMIT)
+
+    @app.post("/upload")
+    async def upload(image: UploadFile = File(...)):
+        received.append(image.filename)
+        return {"size": len(await image.read())}
+
+    @app.post("/raw")
+    async def raw(body: dict):
+        return {"keys": len(body)}
+
+    return TestClient(app)
+
+
+def test_small_upload_reaches_the_route():
+    received = []
+    response = upload_client(received).post("/upload", files={"image": ("a.png", b"x" * 100, "image/png")})
+    assert response.status_code == 200
+    assert response.json() == {"size": 100}
+    assert received == ["a.png"]
+
+
+def test_declared_oversized_upload_is_rejected_before_the_form_is_read():
+    received = []
+    response = upload_client(received).post("/upload", files={"image": ("a.png", b"x" * (LIMIT * 2), "image/png")})
+    assert response.status_code == 413
+    assert received == []
+
+
+def test_chunked_oversized_upload_is_stopped_while_received():
+    received = []
+    boundary = "limit"
+    chunks = [f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"a.png\"\r\n"
+              "Content-Type: image/png\r\n\r\n".encode(),
+              *(b"x" * 512 for _ in range(4)),
+              f"\r\n--{boundary}--\r\n".encode()]
+    response = upload_client(received).post("/upload", content=iter(chunks),
+                                            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+    assert response.status_code == 413
+    assert received == []
+
+
+def test_other_bodies_are_not_limited():
+    response = upload_client([]).post("/raw", json={f"key{i}": "x" * 100 for i in range(20)})
+    assert response.status_code == 200
@@ -0,0 +1,144 @@
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Optional
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from config import settings
+
+RESPONSE_COMPRESSION = settings.response_compression
+COMPRESSION_MIN_SIZE = settings.compression_min_size  # Smaller complete bodies are sent as is
+GZIP_LEVEL = settings.compression_gzip_level
+BROTLI_QUALITY = settings.compression_brotli_quality  # Low qualities keep brotli cheaper than gzip at a better ratio
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/x-ndjson",
+    "image/svg+xml",
+    "text/css",
+    "text/csv",
+    "text/event-stream",
+    "text/html",
+    "text/plain",
+}
+
+# Bytes before and after compression, exposed by /internal/stats
+compression_stats = {"responses": 0, "bytes_in": 0, "bytes_out": 0}
+
+class GzipEncoder:
+    """Incremental gzip stream, every chunk is flushed so it can be decoded on arrival."""
+
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+class BrotliEncoder:
+    """Incremental brotli stream, every chunk is flushed so it can be decoded on arrival."""
+
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick brotli when it is installed and accepted, else gzip when accepted."""
+    accepted = set()
+    for value in accept_encoding.split(","):
+        name, _, params = value.strip().partition(";")
+        if params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+class CompressionMiddleware:
+    """Compress responses with brotli or gzip.
+
+    Only allowlisted content types are compressed, and only when the complete body reaches
+    the size threshold. Streaming responses are always compressed but flushed chunk by chunk,
+    so a streamed token reaches the client as soon as it is produced.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Optional[Message] = None
+        encoder = None
+        passthrough = False
+
+        async def send_compressed(message: Message):
+            nonlocal start_message, encoder, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "").split(";")[0].strip()
+                passthrough = (
+                    message["status"] in (204, 206, 304)
+                    or "content-encoding" in headers
+                    or "no-transform" in headers.get("cache-control", "")
+                    or content_type not in COMPRESSIBLE_TYPES
+                )
+                if passthrough:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                if not more_body and len(body) < self.minimum_size:
+                    # Complete body below the threshold, not worth the CPU
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                encoder = BrotliEncoder(BROTLI_QUALITY) if encoding == "br" else GzipEncoder(GZIP_LEVEL)
+                compressed = encoder.chunk(body) if more_body else encoder.finish(body)
+                headers = MutableHeaders(raw=start_message["headers"])
+                headers["Content-Encoding"] = encoding
+                headers.add_vary_header("Accept-Encoding")
+                if more_body:
+                    if "content-length" in headers:
+                        del headers["content-length"]
+                else:
+                    headers["Content-Length"] = str(len(compressed))
+                if headers.get("etag", "").startswith('"'):
+                    # The encoded bytes differ from the identity representation, so its validator becomes weak
+                    headers["ETag"] = "W/" + headers["etag"]
+                compression_stats["responses"] += 1
+                await send(start_message)
+            else:
+                compressed = encoder.chunk(body) if more_body else encoder.finish(body)
+
+            compression_stats["bytes_in"] += len(body)
+            compression_stats["bytes_out"] += len(compressed)
+            await send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+        await self.app(scope, receive, send_compressed)
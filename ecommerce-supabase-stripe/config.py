@@ -1,4 +1,5 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
+from typing import Optional
 
 class Settings(BaseSettings):
 	app_name: str = 'Awesome API'
@@ -12,7 +13,35 @@ class Settings(BaseSettings):
 	db_host: str
 	db_user: str
 	db_password: str
+	db_async: bool = False  # Serve the routes from an asyncpg engine instead of the threadpool
+	db_port: int = 5432  # 6543 for the Supabase pooler in transaction mode
+	db_pool_size: int = 5  # Connections kept open per worker, size against the Supabase connection limit
+	db_max_overflow: int = 5  # Extra connections opened under bursts and closed when returned
+	db_pool_timeout: float = 30  # Seconds to wait for a free connection before failing
+	db_pool_recycle: int = 1800  # Seconds before a connection is replaced, below the pooler idle timeout
+	db_pool_pre_ping: bool = True  # Check connections on checkout so dropped ones are replaced transparently
+	db_pgbouncer: bool = False  # Behind a transaction mode pooler, disable server side prepared statement caching
+	db_statement_cache_size: int = 100  # asyncpg prepared statement cache, forced to 0 when db_pgbouncer is set
+	supabase_jwt_secret: Optional[str] = None  # Verify HS256 tokens with the project secret, else use the project JWKS
+	supabase_jwt_audience: str = 'authenticated'
+	admin_emails: list[str] = []  # Emails allowed to use the admin routes
 	allowed_hosts: list[str] = ['localhost', 'aws-0-eu-central-1.pooler.supabase.com']
+	catalog_cache_size: int = 1024  # Maximum number of cached catalog responses
+	catalog_cache_ttl: float = 60  # Seconds before a cached catalog response expires
+	answer_cache_size: int = 512  # Maximum number of cached FAQ answers per tier
+	answer_cache_ttl: float = 3600  # Seconds before a cached FAQ answer is generated again
+	answer_similarity_threshold: float = 0.92  # Cosine similarity from which a cached answer is reused for another prompt
+	max_image_size: int = 5 * 1024 * 1024  # Largest accepted product image upload in bytes
+	faq_match_threshold: float = 0.9  # Similarity from which /chat/faq returns the stored FAQ answer without the LLM
+	sse_frame_interval: float = 0.05  # Seconds a token may wait in the buffer before its SSE frame is sent
+	sse_frame_size: int = 256  # Buffered characters that send an SSE frame right away
+	products_cache_control: str = 'no-cache'  # Cache-Control of the product listing, clients revalidate with If-None-Match
+	product_cache_control: str = 'no-cache'  # Cache-Control of a single product
+	search_cache_control: str = 'no-cache'  # Cache-Control of the search results
+	response_compression: bool = True  # Compress responses with brotli or gzip
+	compression_min_size: int = 500  # Smaller complete bodies are sent as is
+	compression_gzip_level: int = 6
+	compression_brotli_quality: int = 4
 
 	model_config = SettingsConfigDict(env_file=".env")
 
@@ -1,13 +1,97 @@
 from sqlmodel import Field, Session, String, SQLModel, create_engine, Relationship, select, Column, func, DateTime
 from pydantic import EmailStr
 from datetime import datetime
-from typing import Optional, Literal
-from uuid import UUID
+from typing import Optional, Literal, Union, Callable, TypeVar, AsyncIterator
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+from fastapi.concurrency import run_in_threadpool
+import os
+import re
+from cache import invalidate_products
+from sqlalchemy import update, Index, text, literal_column
+from sqlalchemy.orm import selectinload
+from uuid import UUID, uuid4
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+import time
 from config import settings
 
-db_url = f'postgresql://{settings.db_user}:{settings.db_password}@{settings.db_host}:5432/postgres'
+db_url = f'postgresql://{settings.db_user}:{settings.db_password}@{settings.db_host}:{settings.db_port}/postgres'
+async_db_url = f'postgresql+asyncpg://{settings.db_user}:{settings.db_password}@{settings.db_host}:{settings.db_port}/postgres'
 
-engine = create_engine(db_url, future=True)
+class CheckoutTimer:
+    """Pool mixin recording how long checkouts wait for a free connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+class TimedQueuePool(CheckoutTimer, QueuePool):
+    pass
+
+class TimedAsyncQueuePool(CheckoutTimer, AsyncAdaptedQueuePool):
+    pass
+
+pool_options = dict(
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+    pool_timeout=settings.db_pool_timeout,
+    pool_recycle=settings.db_pool_recycle,
+    pool_pre_ping=settings.db_pool_pre_ping,
+)
+
+# psycopg2 doesn't use server side prepared statements, so it works with a transaction mode pooler as is
+engine = create_engine(db_url, future=True, poolclass=TimedQueuePool, **pool_options)
+
+# asyncpg prepares statements per connection, which a transaction mode pooler can't route back to the right backend
+async_connect_args = {"statement_cache_size": settings.db_statement_cache_size}
+if settings.db_pgbouncer:
+    async_connect_args = {
+        "statement_cache_size": 0,
+        "prepared_statement_cache_size": 0,
+        "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+    }
+
+# Serve the routes from an asyncpg engine on the event loop instead of the threadpool
+async_engine = create_async_engine(async_db_url, poolclass=TimedAsyncQueuePool, connect_args=async_connect_args, **pool_options) if settings.db_async else None
+
+def pool_stats() -> dict:
+    """Connection counts and checkout waits of the engines in use."""
+    engines = {"sync": engine, "async": async_engine.sync_engine if async_engine is not None else None}
+    stats = {}
+    for name, db_engine in engines.items():
+        if db_engine is None:
+            continue
+        pool = db_engine.pool
+        stats[name] = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "checkouts": pool.checkouts,
+            "timeouts": pool.timeouts,
+            "avg_wait_ms": round(pool.wait_total / pool.checkouts * 1000, 3) if pool.checkouts else 0.0,
+            "max_wait_ms": round(pool.wait_max * 1000, 3),
+        }
+    return stats
+
+T = TypeVar("T")
 
 class User(SQLModel, table=True):
     id: UUID = Field(default=None, primary_key=True)
@@ -21,22 +105,37 @@ class User(SQLModel, table=True):
     orders: list["Order"] = Relationship(back_populates="user")
 
 class Product(SQLModel, table=True):
+    # Composite indexes backing the (sort key, id) keyset pagination of the catalog
+    __table_args__ = (Index("ix_product_name_id", "name", "id"), Index("ix_product_created_at_id", "created_at", "id"))
+
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str = Field(max_length=100, index=True)
     price: float
     stock: int = 10 # Default stock to 10
     description: Optional[str] = None
     image: Optional[str] = None
+    variants_ready: bool = False  # Set once the thumb and medium variants of the image are uploaded
     created_at: Optional[datetime] = Field(sa_column=Column(DateTime(timezone=True), default=func.now(), nullable=False))
     updated_at: Optional[datetime] = Field(sa_column=Column(DateTime(timezone=True), default=func.now(), onupdate=func.now()))
     order_items: list["OrderItem"] = Relationship(back_populates="product", cascade_delete=True)
 
+    @classmethod
+    def bulk_insert(cls, rows: list[dict], db: Session):
+        """Insert a batch of products with one commit, the unit of work sends them as a single executemany."""
+        try:
+            db.add_all([cls(**row) for row in rows])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
     def update_stock(self, quantity: int, db: Session):
         if self.stock >= quantity:
             self.stock -= quantity
             db.add(self)  # Add the updated product to the session
             db.commit()  # Commit the changes to the database
             db.refresh(self)  # Refresh the instance to get the updated data
+            invalidate_products(self.id)  # Drop the cached catalog responses showing the old stock
         else:
             raise ValueError("Not enough stock available")
     
@@ -45,6 +144,20 @@ class Product(SQLModel, table=True):
         if self.image:
             return f"{settings.supabase_bucket_url}/{self.image}"
         return f"{settings.supabase_bucket_url}/default.png"
+
+    @property
+    def thumbnailURL(self) -> str:
+        return self.variantURL("thumb")
+
+    @property
+    def mediumURL(self) -> str:
+        return self.variantURL("medium")
+
+    def variantURL(self, variant: str) -> str:
+        # Variants are stored next to the original as <hash>_<variant>.webp, the original is linked until they are uploaded
+        if self.image and self.variants_ready:
+            return f"{settings.supabase_bucket_url}/{os.path.splitext(self.image)[0]}_{variant}.webp"
+        return self.imageURL
     
 
 class OrderItem(SQLModel, table=True):
@@ -70,6 +183,11 @@ class Order(SQLModel, table=True):
     def total_price(self) -> float:
         return sum(item.product.price * item.quantity for item in self.items if item.product)
 
+    @classmethod
+    def select_with_items(cls):
+        """Select orders with their items and products eager loaded, three queries whatever the number of orders."""
+        return select(cls).options(selectinload(cls.items).selectinload(OrderItem.product))
+
     def update_status(self, new_status: str, db: Session):
         if new_status in ["Pending", "Paid", "Shipped", "Delivered"]:
             self.status = new_status
@@ -80,18 +198,147 @@ class Order(SQLModel, table=True):
             raise ValueError("Invalid status value")
     
     def update_stock(self, db: Session):
+        """Reserve stock for every item in a single transaction. The caller commits or rolls back."""
+        # Merge repeated lines so each product is decremented once
+        quantities: dict[int, int] = {}
         for item in self.items:
-            product = db.exec(select(Product).where(Product.id == item.product_id)).first()
-            if product:
-                product.update_stock(item.quantity, db)
-            else:
-                raise ValueError("Product not found in order items")
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+
+        # Load every product in the order with one IN query
+        products = {product.id: product for product in db.exec(select(Product).where(Product.id.in_(quantities))).all()}
+        if len(products) != len(quantities):
+            raise ValueError("Product not found in order items")
 
+        # Guarded decrement: the row only changes if enough stock is left at write time
+        for product_id, quantity in quantities.items():
+            result = db.execute(
+                update(Product)
+                .where(Product.id == product_id, Product.stock >= quantity)
+                .values(stock=Product.stock - quantity)
+            )
+            if result.rowcount != 1:
+                raise ValueError(f"Not enough stock available for product: {products[product_id].name}")
+
+        # Attach the loaded products so the response doesn't lazy load them again
+        for item in self.items:
+            item.product = products[item.product_id]
+
+    def place(self, db: Session) -> "Order":
+        """Reserve stock and insert the order in one transaction, then reload it with its items and products."""
+        try:
+            self.update_stock(db)  # Raises if any line lacks stock, nothing is committed yet
+            db.add(self)
+            db.commit()
+        except Exception:
+            # Undo any stock already decremented for this order
+            db.rollback()
+            raise
+        return db.exec(Order.select_with_items().where(Order.id == self.id).execution_options(populate_existing=True)).one()
+
+
+# Full-text index over product name and description, a generated tsvector column so Postgres keeps it in sync
+PRODUCT_SEARCH_DDL = [
+    """ALTER TABLE product ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B')
+    ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_product_search_vector ON product USING gin (search_vector)",
+]
+
+# Columns added after the product table was first created, create_all doesn't alter existing tables
+PRODUCT_COLUMNS_DDL = [
+    "ALTER TABLE product ADD COLUMN IF NOT EXISTS variants_ready boolean NOT NULL DEFAULT false",
+]
+
+def add_product_columns():
+    with engine.begin() as conn:
+        for ddl in PRODUCT_COLUMNS_DDL:
+            conn.execute(text(ddl))
+
+def create_search_index():
+    with engine.begin() as conn:
+        for ddl in PRODUCT_SEARCH_DDL:
+            conn.execute(text(ddl))
+
+def match_products(statement, query: str):
+    """Restrict a Product select to full-text matches on name and description, best matches first."""
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return statement
+    # Match every term as a prefix so a partially typed word still matches
+    ts_query = func.to_tsquery("english", " & ".join(f"{term}:*" for term in terms))
+    search_vector = literal_column("product.search_vector")
+    return (statement.where(search_vector.op("@@")(ts_query))
+            .order_by(func.ts_rank(search_vector, ts_query).desc()))
 
 def create_tables():
     SQLModel.metadata.create_all(engine)
+    add_product_columns()
+    create_search_index()
     SQLModel.model_rebuild() # Rebuild the model to ensure all relationships are set up correctly
 
+def mark_variants_ready(image: str):
+    """Flag the products showing an image once its variants are uploaded, called from the image worker."""
+    with Session(engine) as session:
+        product_ids = session.execute(
+            update(Product).where(Product.image == image, Product.variants_ready.is_(False))
+            .values(variants_ready=True).returning(Product.id)
+        ).scalars().all()
+        session.commit()
+    if product_ids:
+        invalidate_products(*product_ids)  # Cached responses still link the original image
+
+def pending_variant_images() -> list[str]:
+    """Images whose variants were never uploaded, they predate variants or their rendering failed."""
+    with Session(engine) as session:
+        return session.exec(select(Product.image).where(Product.image.is_not(None), Product.variants_ready.is_(False)).distinct()).all()
+
 def get_session():
     with Session(engine) as session:
         yield session
+
+async def get_async_session():
+    # Keep attributes loaded after commit, they can't be lazy loaded outside the event loop's greenlet
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+# Session dependency used by the routes, selected by settings.db_async
+get_db = get_async_session if settings.db_async else get_session
+DBSession = Union[Session, AsyncSession]
+
+async def stream_partitions(statement, batch_size: int) -> AsyncIterator[list]:
+    """Yield the rows of a query in partitions read from a server-side cursor (yield_per).
+
+    Streaming responses outlive the request scoped session, so the stream opens a session of its own.
+    """
+    statement = statement.execution_options(yield_per=batch_size)
+    if settings.db_async:
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            result = await session.stream_scalars(statement)
+            async for partition in result.partitions():
+                yield partition
+        return
+    with Session(engine) as session:
+        result = await run_in_threadpool(session.exec, statement)
+        partitions = result.partitions()
+        while partition := await run_in_threadpool(next, partitions, None):
+            yield partition
+
+async def run_db(db: DBSession, fn: Callable[[Session], T]) -> T:
+    """Run fn with a sync Session: on the event loop through AsyncSession.run_sync in async mode, in the threadpool otherwise."""
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn)
+    return await run_in_threadpool(fn, db)
+
+async def exec_all(db: DBSession, statement) -> list:
+    return await run_db(db, lambda session: session.exec(statement).all())
+
+async def exec_first(db: DBSession, statement):
+    return await run_db(db, lambda session: session.exec(statement).first())
+
+def save(db: Session, instance: T) -> T:
+    """Insert or update a single instance and reload it."""
+    db.add(instance)
+    db.commit()
+    db.refresh(instance)
+    return instance
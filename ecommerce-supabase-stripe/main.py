@@ -1,12 +1,16 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from database import create_tables
+from database import create_tables, async_engine, pool_stats, pending_variant_images, mark_variants_ready
+from supabase_client import backfill_variants
 from contextlib import asynccontextmanager
-from routes.auth import router as auth_router
+from routes.auth import router as auth_router, admin_depends
 from routes.store import router as store_router
-from routes.chat import router as chat_router
+from routes.chat import router as chat_router, chat_stats
 from logger_config import logger
+from cache import catalog_cache, answer_cache, semantic_answer_cache
+from compression import CompressionMiddleware, RESPONSE_COMPRESSION, compression_stats
+from upload_limit import UploadLimitMiddleware, FORM_OVERHEAD
 import os
 import uvicorn
 from config import settings
@@ -14,12 +18,23 @@ from config import settings
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     create_tables()
+    backfill_variants(pending_variant_images(), mark_variants_ready)  # Queued on the image executor, startup doesn't wait for the rendering
     yield
+    if async_engine is not None:
+        await async_engine.dispose()
 
 app = FastAPI(lifespan=lifespan,
             title=settings.app_name,
             description=settings.app_description,
-            version=settings.app_version)
+            version=settings.app_version,
+            default_response_class=ORJSONResponse)  # orjson for routes returning plain data
+
+# Refuse oversized image uploads before the multipart body is spooled
+app.add_middleware(UploadLimitMiddleware, max_body_size=settings.max_image_size + FORM_OVERHEAD)
+
+# Compress responses, streamed chunks are flushed one by one
+if RESPONSE_COMPRESSION:
+    app.add_middleware(CompressionMiddleware)
 
 # Enable CORS
 app.add_middleware(
@@ -28,6 +43,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],  # Let browsers read the pagination cursor and validators
 )
 
 # Custom exception handler for HTTPException
@@ -44,5 +60,14 @@ app.include_router(auth_router)
 app.include_router(store_router)
 app.include_router(chat_router)
 
+# Internal runtime stats, admins only and hidden from the public API docs
+@app.get("/internal/stats", include_in_schema=False)
+def internal_stats(current_user: admin_depends):
+    return {"catalog_cache": catalog_cache.stats(),
+            "compression": compression_stats,
+            "answer_cache": {"exact": answer_cache.stats(), "semantic": semantic_answer_cache.stats()},
+            "chat": chat_stats(),
+            "db_pool": pool_stats()}
+
 if __name__ == "__main__":
     uvicorn.run("main:app", log_level="info", reload=True)
\ No newline at end of file
@@ -1,41 +1,83 @@
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi import Depends, HTTPException, APIRouter, status
-from sqlmodel import Session, select
-from database import User, get_session
+from sqlmodel import select
+from database import User, get_db, DBSession, run_db, exec_first, save
+from fastapi.concurrency import run_in_threadpool
 from schemas import Token, UserOut, UserIn
 from typing import Annotated
 from supabase_client import get_supabase
 from supabase import Client
+from utils import decode_access_token
+import jwt
 import uuid
+from config import settings
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
 # User authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
-def get_current_user(token: str = Depends(oauth2_scheme),
+async def get_current_user(token: str = Depends(oauth2_scheme), db: DBSession = Depends(get_db)) -> UserOut:
+    try:
+        # Verify the token locally and take the user id from the sub claim
+        payload = decode_access_token(token)
+        user_id = payload.get("sub")
+        if user_id is None:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
+
+        # Load the user by primary key
+        user_db = await run_db(db, lambda session: session.get(User, uuid.UUID(user_id)))
+        if not user_db:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+        return user_db
+
+    except HTTPException:
+        raise
+
+    except (jwt.PyJWTError, ValueError):
+        # Invalid signature, expired token, wrong audience or malformed sub claim
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
+
+    except Exception as e:
+        # Catch any unexpected exceptions and log them
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error")
+
+async def get_current_user_verified(token: str = Depends(oauth2_scheme),
                     supabase: Client = Depends(get_supabase),
-                    db: Session = Depends(get_session)) -> UserOut:
+                    db: DBSession = Depends(get_db)) -> UserOut:
+    """Check the token with Supabase Auth on every call so revoked sessions are rejected. Opt-in for revocation-sensitive routes."""
     try:
-        response = supabase.auth.get_user(token)
+        response = await run_in_threadpool(supabase.auth.get_user, token)
         user = response.user
         if not user:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid authentication credentials")
-        user_db = db.exec(select(User).where(User.email == user.email)).first()
+        user_db = await run_db(db, lambda session: session.get(User, uuid.UUID(user.id)))
         if not user_db:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
         return user_db
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         # Catch any unexpected exceptions and log them
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error")
 
 user_depends = Annotated[UserOut, Depends(get_current_user)]
+verified_user_depends = Annotated[UserOut, Depends(get_current_user_verified)]
+
+async def get_current_admin(current_user: user_depends) -> UserOut:
+    # Admin routes are limited to the configured emails
+    if current_user.email.lower() not in {email.lower() for email in settings.admin_emails}:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
+admin_depends = Annotated[UserOut, Depends(get_current_admin)]
 
 @router.post("/token", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), supabase: Client = Depends(get_supabase)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), supabase: Client = Depends(get_supabase)):
     try:
-        response = supabase.auth.sign_in_with_password(
+        response = await run_in_threadpool(supabase.auth.sign_in_with_password,
             {
                 "email": form_data.username, 
                 "password": form_data.password
@@ -51,9 +93,9 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), supabase: Client = D
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred during login")
 
 @router.post("/register", response_model=UserOut)
-def register(user: UserIn, db: Session = Depends(get_session), supabase: Client = Depends(get_supabase)):
+async def register(user: UserIn, db: DBSession = Depends(get_db), supabase: Client = Depends(get_supabase)):
     try:
-        response = supabase.auth.sign_up(
+        response = await run_in_threadpool(supabase.auth.sign_up,
             {
                 "email":  user.email, 
                 "password": user.password,
@@ -66,13 +108,11 @@ def register(user: UserIn, db: Session = Depends(get_session), supabase: Client
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User creation failed")
         
         # Assuming the user is created successfully in Supabase, we can now create a local user in our database
-        existing_user = db.exec(select(User).where(User.email == user.email)).first()
+        existing_user = await exec_first(db, select(User).where(User.email == user.email))
         if existing_user:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
         db_user = User(id=user_id, username=user.username, email=user.email, first_name=user.first_name, last_name=user.last_name)
-        db.add(db_user)
-        db.commit()
-        db.refresh(db_user)  # Refresh the instance to get the updated data
+        db_user = await run_db(db, lambda session: save(session, db_user))
         
         return db_user
 
@@ -81,7 +121,7 @@ def register(user: UserIn, db: Session = Depends(get_session), supabase: Client
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An error occurred during registration")
 
 @router.get("/me", response_model=UserOut)
-def read_users_me(current_user: user_depends):
+async def read_users_me(current_user: user_depends):
     try:
         return current_user
     except Exception as e:
@@ -40,6 +40,8 @@ class ProductOut(BaseModel):
     stock: int 
     description: Optional[str]
     imageURL: Optional[str]
+    thumbnailURL: Optional[str]
+    mediumURL: Optional[str]
     created_at: datetime
     updated_at: Optional[datetime] 
 
@@ -67,6 +69,7 @@ class OrderIn(BaseModel):
         from_attributes = True
 
 class OrderOut(BaseModel):
+    id: Optional[int] = None
     items: List[OrderItemOut]
     total_price: float
     status: Literal["Pending", "Paid", "Shipped", "Delivered"]
@@ -75,6 +78,14 @@ class OrderOut(BaseModel):
 
     class Config:
         from_attributes = True
+
+class OrderExport(OrderOut):
+    user_id: Optional[UUID]
         
 class ChatRequest(BaseModel):
     prompt: str
+
+class FAQMatch(BaseModel):
+    question: str
+    answer: str
+    score: float = Field(..., description="Cosine similarity between the query and the FAQ question, 1 is identical")
@@ -1,13 +1,73 @@
 from supabase import create_client, Client
+from storage3.utils import StorageException
 from fastapi import UploadFile
-from uuid import uuid4
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
 from config import settings
+from logger_config import logger
+import hashlib
+import io
 import os
 
 supabase: Client = create_client(settings.supabase_url, settings.supabase_key)
 
-# Upload to s3 bucket and return url
-def upload_image(image: UploadFile, bucket_name: str = "products") -> str:
+# Responsive variants generated for every uploaded image, longest side in pixels
+IMAGE_VARIANTS = {"thumb": 200, "medium": 600}
+
+# Variants are rendered and uploaded in the background so the upload request doesn't wait for them
+image_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image")
+
+# Function to tell whether a storage error means the object is already stored
+def is_duplicate(e: StorageException) -> bool:
+    error = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+    return str(error.get("statusCode")) == "409" or error.get("error") == "Duplicate"
+
+# Function to upload an object once, an existing object with the same content addressed name is reused
+def upload_once(bucket_name: str, filename: str, data: bytes, mime_type: str):
+    try:
+        supabase.storage.from_(bucket_name).upload(filename, data, file_options={"content-type": mime_type, "cache-control": "31536000"})
+    except StorageException as e:
+        if not is_duplicate(e):
+            raise
+
+# Function to render the WebP variants of an image and upload them next to the original
+def upload_variants(data: bytes, filename: str, bucket_name: str):
+    stem = os.path.splitext(filename)[0]
+    with Image.open(io.BytesIO(data)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ("RGB", "RGBA"):
+            original = original.convert("RGBA")
+        for variant, size in IMAGE_VARIANTS.items():
+            resized = original.copy()
+            resized.thumbnail((size, size))
+            buffer = io.BytesIO()
+            resized.save(buffer, format="WEBP", quality=80, method=4)
+            upload_once(bucket_name, f"{stem}_{variant}.webp", buffer.getvalue(), "image/webp")
+
+# Function to render and upload the variants of a stored image, downloaded from the bucket when its data isn't given
+def render_variants(filename: str, on_ready: Callable[[str], None], bucket_name: str = "products", data: Optional[bytes] = None):
+    if data is None:
+        data = supabase.storage.from_(bucket_name).download(filename)
+    upload_variants(data, filename, bucket_name)
+    on_ready(filename)  # Only once every variant is stored, so no product links a missing one
+
+# Function to render the variants of an uploaded image in the background, the upload request doesn't wait for them
+def queue_variants(filename: str, data: bytes, on_ready: Callable[[str], None], bucket_name: str = "products"):
+    image_executor.submit(render_variants, filename, on_ready, bucket_name, data).add_done_callback(log_variant_failure)
+
+# Function to queue the variants of images stored before variants existed or whose rendering failed
+def backfill_variants(filenames: list[str], on_ready: Callable[[str], None], bucket_name: str = "products"):
+    for filename in filenames:
+        image_executor.submit(render_variants, filename, on_ready, bucket_name).add_done_callback(log_variant_failure)
+
+# Function to log a failed variant upload, the original image stays usable
+def log_variant_failure(future):
+    if future.exception():
+        logger.error(f"Image variant generation failed: {str(future.exception())}")
+
+# Upload to s3 bucket and return the stored name with the image data, for queue_variants
+def upload_image(image: UploadFile, bucket_name: str = "products") -> tuple[str, bytes]:
     # Get the file extension
     ext = os.path.splitext(image.filename)[1].lower()
     
@@ -15,23 +75,16 @@ def upload_image(image: UploadFile, bucket_name: str = "products") -> str:
     if ext not in {".jpg", ".jpeg", ".png"}:
         raise ValueError("Invalid image format. Only .jpg, .jpeg, and .png are allowed.")
     
-    # Generate a unique filename
-    filename = f"{uuid4().hex}{ext}"
-
     ## Set the file options
     mime_type = image.content_type
     
     # Upload the image to the specified bucket
     try:
-        # Open the image file and upload
+        # Open the image file and name it after its content hash, so re-uploads of the same file collapse to one
         file_data = image.file.read()
-        response = supabase.storage.from_(bucket_name).upload(filename, file_data, file_options={'content-type': mime_type})
-
-        # Check if the upload was successful
-        if not response:
-            raise Exception(f"Upload failed")
-        
-        return filename
+        filename = f"{hashlib.sha256(file_data).hexdigest()}{ext}"
+        upload_once(bucket_name, filename, file_data, mime_type)
+        return filename, file_data
     except Exception as e:
         raise Exception(f"An error occurred during the upload: {e}")
 
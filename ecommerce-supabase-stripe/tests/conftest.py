@@ -0,0 +1,20 @@
+import os
+import sys
+
+# The app modules are imported as top level modules, the same way main.py imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Offline settings: nothing below is contacted, tokens are verified with the HS256 test secret
+TEST_SETTINGS = {
+    "SUPABASE_URL": "http://localhost:54321",
+    "SUPABASE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.test",  # Shaped like a JWT as the client requires
+    "SUPABASE_BUCKET_URL": "http://localhost:54321/storage/v1/object/public/products",
+    "SUPABASE_JWT_SECRET": "test-secret-with-at-least-32-bytes!",
+    "STRIPE_KEY": "sk_test",
+    "STRIPE_ENDPOINT_SECRET": "whsec_test",
+    "DB_HOST": "localhost",
+    "DB_USER": "postgres",
+    "DB_PASSWORD": "postgres",
+}
+for name, value in TEST_SETTINGS.items():
+    os.environ[name] = value
@@ -0,0 +1,62 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+import jwt
+import pytest
+from fastapi import HTTPException
+from config import settings
+from routes.auth import get_current_user, get_current_user_verified
+
+KNOWN_USER = SimpleNamespace(id=uuid.uuid4(), email="buyer@example.com")
+
+
+class FakeSession:
+    """Stands in for the database session, only the known user exists."""
+
+    def get(self, model, user_id):
+        return KNOWN_USER if user_id == KNOWN_USER.id else None
+
+
+def sign(sub=str(KNOWN_USER.id), audience=None, expires_in=timedelta(hours=1), secret=None) -> str:
+    claims = {"sub": sub, "aud": audience or settings.supabase_jwt_audience,
+              "exp": datetime.now(timezone.utc) + expires_in}
+    return jwt.encode(claims, secret or settings.supabase_jwt_secret, algorithm="HS256")
+
+
+def current_user(token: str):
+    return asyncio.run(get_current_user(token, FakeSession()))
+
+
+def test_valid_token_resolves_the_user():
+    assert current_user(sign()) is KNOWN_USER
+
+
+@pytest.mark.parametrize("token", [
+    sign(expires_in=timedelta(minutes=-1)),  # Expired
+    sign(audience="anon"),  # Wrong audience
+    sign(secret="another-secret-with-at-least-32-bytes"),  # Wrong signature
+    sign(sub=str(uuid.uuid4())),  # Unknown subject
+    sign(sub="not-a-uuid"),  # Malformed subject
+    "not a token",
+])
+def test_invalid_token_is_unauthorized(token):
+    with pytest.raises(HTTPException) as error:
+        current_user(token)
+    assert error.value.status_code == 401
+
+
+def verified_user(auth_user):
+    supabase = SimpleNamespace(auth=SimpleNamespace(get_user=lambda token: SimpleNamespace(user=auth_user)))
+    return asyncio.run(get_current_user_verified("token", supabase, FakeSession()))
+
+
+def test_verified_token_resolves_the_user():
+    assert verified_user(SimpleNamespace(id=str(KNOWN_USER.id))) is KNOWN_USER
+
+
+@pytest.mark.parametrize("auth_user", [None, SimpleNamespace(id=str(uuid.uuid4()))])
+def test_revoked_or_unknown_verified_token_is_unauthorized(auth_user):
+    with pytest.raises(HTTPException) as error:
+        verified_user(auth_user)
+    assert error.value.status_code == 401
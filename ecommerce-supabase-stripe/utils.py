@@ -0,0 +1,182 @@
+from jwt import PyJWKClient
+from config import settings
+from typing import Optional, Union, List, AsyncIterator, Callable
+from pydantic import BaseModel
+import base64
+import codecs
+import csv
+import io
+import json
+import jwt
+
+# Function to encode an opaque pagination cursor from the last row of a page
+def encode_cursor(order_by: str, sort_value, last_id) -> str:
+    payload = json.dumps([order_by, sort_value, last_id], default=str)
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+# Function to decode a pagination cursor, it must have been issued for the same ordering
+def decode_cursor(cursor: str, order_by: str) -> tuple:
+    try:
+        cursor_order_by, sort_value, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if cursor_order_by != order_by:
+        raise ValueError("Cursor does not match the requested ordering")
+    return sort_value, last_id
+
+# Bulk import settings
+IMPORT_BATCH_SIZE = 500  # Rows inserted per round trip, overridable per request
+IMPORT_MAX_ERRORS = 1000  # Row errors listed in the import report, the failed count keeps counting past it
+IMPORT_MAX_RECORD_SIZE = 64 * 1024  # Characters an NDJSON line or a CSV record may span, a longer one is rejected rather than buffered
+IMPORT_FORMATS = {"application/x-ndjson": "ndjson", "application/jsonl": "ndjson", "text/csv": "csv"}
+
+# Function to map the content type of an import body to its format
+def import_format(content_type: Optional[str]) -> Optional[str]:
+    return IMPORT_FORMATS.get((content_type or "").split(";")[0].strip().lower())
+
+# Function to parse a streamed NDJSON or CSV body row by row, yields (row number, fields) or (row number, parse error)
+async def iter_import_rows(chunks: AsyncIterator[bytes], fmt: str) -> AsyncIterator[tuple[int, Union[dict, str]]]:
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    header, pending, row = None, [], 0
+    buffer, buffered, skipping = [], 0, False
+
+    def parse_ndjson(lines: List[str]):
+        nonlocal row
+        for line in lines:
+            if not line.strip():
+                continue
+            row += 1
+            try:
+                fields = json.loads(line)
+            except ValueError as e:
+                yield row, f"Invalid JSON: {str(e)}"
+                continue
+            if not isinstance(fields, dict):
+                yield row, "Expected a JSON object"
+                continue
+            yield row, fields
+
+    def parse_csv(lines: List[str], final: bool = False):
+        nonlocal header, row
+        # Lines of a record still open at the end of the chunk are parsed again with the next one
+        pending.extend(line + "\n" for line in lines)
+        while pending:
+            reader = csv.reader(iter(pending), strict=True)
+            consumed, oversized = 0, False
+            while True:
+                try:
+                    fields = next(reader)
+                except StopIteration:
+                    break
+                except csv.Error as e:
+                    unterminated = reader.line_num == len(pending) and "unexpected end of data" in str(e)
+                    oversized = unterminated and sum(map(len, pending[consumed:])) > IMPORT_MAX_RECORD_SIZE
+                    if oversized or (unterminated and not final):
+                        break  # The quoted field goes on in the next chunk, unless it is already too long
+                    consumed = reader.line_num
+                    row += 1
+                    yield row, "Unterminated quoted field" if unterminated else f"Invalid CSV: {str(e)}"
+                    continue
+                consumed = reader.line_num
+                if not "".join(fields).strip():
+                    continue
+                if header is None:
+                    header = [name.strip() for name in fields]
+                    continue
+                row += 1
+                if len(fields) != len(header):
+                    yield row, f"Expected {len(header)} columns, got {len(fields)}"
+                    continue
+                # Empty cells are left out so the defaults apply
+                yield row, {name: value for name, value in zip(header, fields) if value != ""}
+            del pending[:consumed]
+            if not oversized:
+                break
+            # Rejected rather than buffered, parsing resumes after the line that opened the quoted field
+            del pending[0]
+            row += 1
+            yield row, f"Record longer than {IMPORT_MAX_RECORD_SIZE} characters"
+
+    def parse_lines(lines: List[str]):
+        # Complete lines longer than the limit are rejected without parsing them
+        parse = parse_csv if fmt == "csv" else parse_ndjson
+        start = 0
+        for index, line in enumerate(lines):
+            if len(line) > IMPORT_MAX_RECORD_SIZE:
+                yield from parse(lines[start:index])
+                start = index + 1
+                yield reject_long_line()
+        yield from parse(lines[start:])
+
+    def reject_long_line() -> tuple[int, str]:
+        nonlocal row
+        pending.clear()  # A CSV record open on that line is dropped with it
+        row += 1
+        return row, f"Line longer than {IMPORT_MAX_RECORD_SIZE} characters"
+
+    async for chunk in chunks:
+        *lines, tail = decoder.decode(chunk).split("\n")
+        if lines:
+            if skipping:
+                lines.pop(0)  # End of the line that was too long, resume after it
+                skipping = False
+            else:
+                lines[0] = "".join(buffer) + lines[0]
+            buffer, buffered = [], 0
+            for parsed in parse_lines(lines):
+                yield parsed
+        if skipping:
+            continue
+        # Incomplete last line, completed by the next chunks unless it grows too long
+        buffer.append(tail)
+        buffered += len(tail)
+        if buffered > IMPORT_MAX_RECORD_SIZE:
+            buffer, buffered, skipping = [], 0, True
+            yield reject_long_line()
+    last_line = ["" if skipping else "".join(buffer) + decoder.decode(b"", final=True)]
+    for parsed in parse_csv(last_line, final=True) if fmt == "csv" else parse_ndjson(last_line):
+        yield parsed
+
+# Export settings
+EXPORT_BATCH_SIZE = 1000  # Rows fetched from the cursor and written per response chunk
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+# Function to encode partitions of rows as NDJSON or CSV, every partition becomes one chunk of the response
+async def encode_export(partitions: AsyncIterator[list], model: type[BaseModel], fmt: str,
+                        flatten: Callable[[dict], List[dict]] = lambda record: [record]) -> AsyncIterator[bytes]:
+    header = None
+    async for partition in partitions:
+        records = [model.model_validate(row) for row in partition]
+        if fmt == "ndjson":
+            yield b"".join(record.model_dump_json().encode() + b"\n" for record in records)
+            continue
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for record in records:
+            for line in flatten(record.model_dump(mode="json")):
+                if header is None:
+                    header = list(line)
+                    writer.writerow(header)
+                writer.writerow([line.get(name) for name in header])
+        if buffer.tell():
+            yield buffer.getvalue().encode()
+
+# Function to flatten an order into one CSV line per item, an order without items keeps one line with empty item columns
+def flatten_order(order: dict) -> List[dict]:
+    fields = {name: value for name, value in order.items() if not isinstance(value, list)}
+    items = next((value for value in order.values() if isinstance(value, list)), [])
+    if not items:
+        return [{**fields, "product_id": None, "product_name": None, "unit_price": None, "quantity": None}]
+    return [{**fields, "product_id": item["product"]["id"], "product_name": item["product"]["name"],
+             "unit_price": item["product"]["price"], "quantity": item["quantity"]} for item in items]
+
+# Signing keys of the project, fetched once and cached by the client
+jwks_client = PyJWKClient(f"{settings.supabase_url}/auth/v1/.well-known/jwks.json", cache_keys=True)
+
+# Function to verify a Supabase access token locally, without a round trip to Supabase Auth
+def decode_access_token(token: str) -> dict:
+    if settings.supabase_jwt_secret:
+        key, algorithms = settings.supabase_jwt_secret, ["HS256"]
+    else:
+        key, algorithms = jwks_client.get_signing_key_from_jwt(token).key, ["ES256", "RS256"]
+    return jwt.decode(token, key, algorithms=algorithms, audience=settings.supabase_jwt_audience)